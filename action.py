@@ -8,30 +8,58 @@ Created by Tristan Jehan and Jason Sundram.
 
 from __future__ import print_function
 import os
-from numpy import zeros, multiply, float32, mean, copy
+from numpy import (array, empty, multiply, float32, float64, mean, clip, int16, save, load, 
+                   broadcast_to, newaxis)
 from math import atan, pi
 import sys
+import shutil
+import tempfile
 import subprocess
+import threading
+import multiprocessing
+from Queue import Queue
+from multiprocessing.pool import ThreadPool
 
 from echonest.remix.audio import assemble, AudioData
-from cAction import limit, crossfade, fadein, fadeout
 import echonest
 
-import dirac
+import fades
+import timestretch
+import render_trace
+from render_trace import span
+from render_cache import track_identity
 
 
-ffmpeg_command = None
-for command in ("avconv", "ffmpeg", "en-ffmpeg"):
-	try:
-		subprocess.Popen([command],stdout=subprocess.PIPE,stderr=subprocess.STDOUT).wait()
-		ffmpeg_command = command
-		break
-	except OSError:
-		# The command wasn't found. Move on to the next one.
-		pass
-if not ffmpeg_command:
-	raise RuntimeError("No avconv/ffmpeg found, cannot continue")
-echonest.remix.support.ffmpeg.FFMPEG = ffmpeg_command
+# The encoder is probed for on first use rather than at import, once per 
+# process. Set REMIX_FFMPEG, or call set_ffmpeg(), to skip the probe.
+ffmpeg_command = os.environ.get('REMIX_FFMPEG') or None
+
+def find_ffmpeg():
+    """Returns the avconv/ffmpeg command to use, probing for it the first time 
+    and pointing echonest.remix at it."""
+    global ffmpeg_command
+    if ffmpeg_command is None:
+        for command in ("avconv", "ffmpeg", "en-ffmpeg"):
+            try:
+                subprocess.Popen([command], stdout=subprocess.PIPE, 
+                                 stderr=subprocess.STDOUT).wait()
+                break
+            except OSError:
+                # The command wasn't found. Move on to the next one.
+                pass
+        else:
+            raise RuntimeError("No avconv/ffmpeg found, cannot continue")
+        set_ffmpeg(command)
+    return ffmpeg_command
+
+def set_ffmpeg(command):
+    """Overrides the cached encoder command."""
+    global ffmpeg_command
+    ffmpeg_command = command
+    echonest.remix.support.ffmpeg.FFMPEG = command
+
+if ffmpeg_command:
+    set_ffmpeg(ffmpeg_command)
 
 def rows(m):
     """returns the # of rows in a numpy matrix"""
@@ -40,28 +68,338 @@ def rows(m):
 def make_mono(track):
     """Converts stereo tracks to mono; leaves mono tracks alone."""
     if track.data.ndim == 2:
-        mono = mean(track.data,1)
+        mono = mean(track.data, 1, dtype=float32)
         track.data = mono
         track.numChannels = 1
     return track
 
 def make_stereo(track):
-    """If the track is mono, doubles it. otherwise, does nothing."""
+    """If the track is mono, doubles it. otherwise, does nothing.
+    The stereo data is a read-only view that repeats each mono frame, 
+    not a copy."""
     if track.data.ndim == 1:
-        stereo = zeros((len(track.data), 2))
-        stereo[:,0] = copy(track.data)
-        stereo[:,1] = copy(track.data)
-        track.data = stereo
+        track.data = broadcast_to(track.data[:, newaxis], (len(track.data), 2))
         track.numChannels = 2
     return track
 
-def render(actions, filename, verbose=True):
+
+class BufferPool(object):
+    """Float32 scratch buffers handed out for rendering and taken back once 
+    a piece has been encoded, so render workers don't allocate and free a 
+    new array for every action. Buffers are kept flat and rounded up to a 
+    power of two, so a piece can reuse any free buffer at least its size."""
+    def __init__(self, max_bytes=64 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.free = []
+        self.bytes = 0
+        self.lock = threading.Lock()
+    
+    def take(self, shape):
+        size = 1
+        for n in shape:
+            size *= n
+        with self.lock:
+            fits = [i for i, b in enumerate(self.free) if b.size >= size]
+            if fits:
+                # By index: list.remove would compare the arrays elementwise.
+                buf = self.free.pop(min(fits, key=lambda i: self.free[i].size))
+                self.bytes -= buf.nbytes
+                return buf[:size].reshape(shape)
+        capacity = 1
+        while capacity < size:
+            capacity *= 2
+        return empty(capacity, dtype=float32)[:size].reshape(shape)
+    
+    def give(self, buf):
+        """Returns a buffer from take(); it must no longer be in use."""
+        if buf.base is not None:
+            buf = buf.base
+        with self.lock:
+            if self.bytes + buf.nbytes <= self.max_bytes:
+                self.free.append(buf)
+                self.bytes += buf.nbytes
+
+buffers = BufferPool()
+
+def apply_gain(data, gain, out=None):
+    """Scales data by gain and hard-limits it to the 16-bit range, in place 
+    on out: a buffer from the pool unless given. Returns out."""
+    if out is None:
+        out = buffers.take(data.shape)
+    multiply(data, float32(gain), out=out)
+    return clip(out, -32767, 32767, out=out)
+
+def track_gain(track):
+    """The gain track's audio is scaled by: 1 when it has none."""
+    gain = getattr(track, 'gain', None)
+    return 1.0 if gain is None else gain
+
+def crossfade_pieces(piece1, piece2, mode, gains=(1.0, 1.0), frames=None):
+    """Crossfades two AudioDatas over their first frames (all they share if 
+    None), scaling each by its gain in the same pass, into a pooled buffer."""
+    d1, d2 = make_stereo(piece1).data, make_stereo(piece2).data
+    n = min(len(d1), len(d2), frames if frames is not None else len(d1))
+    vecout = fades.crossfade(d1[:n], d2[:n], mode, out=buffers.take((n, 2)), gains=gains)
+    clip(vecout, -32767, 32767, out=vecout)
+    audio_out = AudioData(ndarray=vecout, shape=vecout.shape, 
+                            sampleRate=piece1.sampleRate, numChannels=2)
+    audio_out.pool_buffer = vecout
+    return audio_out
+
+def release(piece):
+    """Gives a rendered piece's pooled buffer back once it has been consumed."""
+    buf = getattr(piece, 'pool_buffer', None)
+    if buf is not None:
+        piece.pool_buffer = None
+        buffers.give(buf)
+
+def render(actions, filename, verbose=True, stream=False, parallel=False, 
+           processes=None, cache=None):
     """Calls render on each action in actions, concatenates the results, 
-    renders an audio file, and returns a path to the file"""
-    pieces = [a.render() for a in actions]
+    renders an audio file, and returns a path to the file.
+    With stream=True the pieces are piped into the encoder as they are 
+    rendered and never concatenated, so the returned AudioData is None.
+    With parallel=True the actions are spread across worker processes.
+    cache is an optional render_cache.RenderCache."""
+    if stream:
+        return None, stream_render(actions, filename, verbose=verbose, 
+                                   parallel=parallel, processes=processes, 
+                                   cache=cache)
+    pieces = list(render_pieces(actions, parallel, processes, cache))
     # TODO: allow numChannels and sampleRate to vary.
-    out = assemble(pieces, numChannels=2, sampleRate=44100, verbose=verbose)
-    return out, out.encode(filename)
+    with span('assemble', 'mix') as result:
+        out = assemble(pieces, numChannels=2, sampleRate=44100, verbose=verbose)
+        result['data'] = out.data
+    for piece in pieces:
+        release(piece)
+    find_ffmpeg()
+    with span('encode', 'mix'):
+        encoded = out.encode(filename)
+    return out, encoded
+
+
+def render_pieces(actions, parallel=False, processes=None, cache=None):
+    """Yields the rendered AudioData of each action, in order."""
+    if parallel:
+        return parallel_pieces(actions, processes, cache)
+    if cache is not None:
+        return (cache.render(a) for a in actions)
+    return (render_trace.render(a) for a in actions)
+
+
+# Shared with forked workers so actions (and the tracks they hold) are never 
+# pickled on the way in.
+# Set in each worker process by _pool_init, never in the parent, so 
+# concurrent parallel renders don't share them.
+_pool_actions = None
+_pool_dir = None
+
+def _pool_init(actions, directory):
+    """Gives a worker process its render's actions. Workers are forked, so 
+    the actions are inherited rather than pickled."""
+    global _pool_actions, _pool_dir
+    _pool_actions, _pool_dir = actions, directory
+
+def _render_to_file(index):
+    """Renders one action in a worker and saves its frames as .npy, so only 
+    a path travels back through the result pipe."""
+    piece = render_trace.render(_pool_actions[index])
+    path = os.path.join(_pool_dir, '%d.npy' % index)
+    save(path, piece.data)
+    release(piece)
+    return path, piece.sampleRate
+
+def parallel_pieces(actions, processes=None, cache=None):
+    """Renders actions across a pool of processes (one per core by default), 
+    yielding the pieces in the original order as memory-mapped AudioData. 
+    Only actions missing from cache are sent to the workers."""
+    actions = list(actions)
+    if cache is not None:
+        from render_cache import action_key
+        keys = [action_key(a) for a in actions]
+        cached = [cache.get(k) for k in keys]
+    else:
+        keys = cached = [None] * len(actions)
+    directory = tempfile.mkdtemp(prefix='render-')
+    pool = multiprocessing.Pool(processes, _pool_init, (actions, directory))
+    try:
+        misses = [i for i, piece in enumerate(cached) if piece is None]
+        results = pool.imap(_render_to_file, misses)
+        for key, piece in zip(keys, cached):
+            if piece is None:
+                path, sampleRate = next(results)
+                data = load(path, mmap_mode='r')
+                numChannels = data.shape[1] if data.ndim == 2 else 1
+                piece = AudioData(ndarray=data, shape=data.shape, 
+                                  sampleRate=sampleRate, 
+                                  numChannels=numChannels)
+                if cache is not None:
+                    cache.put(key, piece)
+            yield piece
+        pool.close()
+    finally:
+        pool.terminate()
+        # Mapped pieces stay readable after their files are unlinked.
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def pcm_bytes(piece, out=None):
+    """Returns the frames of an AudioData as interleaved 16-bit stereo PCM. 
+    out is an optional int16 scratch array to convert into, at least as 
+    long as the piece."""
+    data = make_stereo(piece).data
+    if data.dtype != int16:
+        scratch = buffers.take(data.shape)
+        clip(data, -32768, 32767, out=scratch)
+        if out is None or len(out) < len(data):
+            out = empty(data.shape, dtype=int16)
+        data = out[:len(data)]
+        data[...] = scratch
+        buffers.give(scratch)
+    return data.tostring()
+
+
+class PCMWriter(object):
+    """A long-lived encoder process fed raw PCM through its stdin, so encoding 
+    runs alongside rendering and no temp WAV is written. The format follows 
+    the filename's extension; bitRate=None leaves it to ffmpeg, as for 
+    lossless formats like .flac and .wav."""
+    def __init__(self, filename, sampleRate=44100, numChannels=2, 
+                 bitRate=128, verbose=True):
+        self.filename = filename
+        self.frames = 0
+        self.scratch = None
+        command = [find_ffmpeg(), '-y', '-f', 's16le', 
+                   '-ar', str(sampleRate), '-ac', str(numChannels), '-i', '-']
+        if bitRate:
+            command += ['-ab', '%dk' % bitRate]
+        command += ['-ac', str(numChannels), '-ar', str(sampleRate), filename]
+        if verbose:
+            print(command)
+            stderr = None
+        else:
+            stderr = open(os.devnull, 'w')
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, 
+                                        stdout=stderr, stderr=stderr)
+    
+    def write(self, piece):
+        """Encodes one rendered AudioData; blocks only while the pipe is full."""
+        n = len(piece.data)
+        if self.scratch is None or len(self.scratch) < n:
+            self.scratch = empty((n, 2), dtype=int16)
+        # Includes time blocked on a full pipe, i.e. waiting for the encoder.
+        with span('encode', 'encode') as result:
+            self.write_frames(pcm_bytes(piece, self.scratch))
+            result['data'] = piece.data
+    
+    def write_frames(self, frames):
+        """Encodes interleaved 16-bit PCM, as returned by pcm_bytes."""
+        self.process.stdin.write(frames)
+        self.frames += len(frames) // 4
+    
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError("Encoding %s failed" % self.filename)
+        return self.filename
+    
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+
+
+class FanoutWriter(object):
+    """Encodes the same PCM to several files at once. outputs is a list of 
+    (filename, bitRate) pairs, e.g. [('mix.mp3', 320), ('mix-128.mp3', 128), 
+    ('mix.flac', None)]. Each piece is converted to PCM once, and the same 
+    string is queued to a feeder thread per encoder, so the encoders run 
+    concurrently and the slowest one sets the pace."""
+    def __init__(self, outputs, sampleRate=44100, numChannels=2, verbose=True, 
+                 depth=4):
+        self.writers = [PCMWriter(filename, sampleRate, numChannels, bitRate, verbose) 
+                        for filename, bitRate in outputs]
+        self.queues = [Queue(maxsize=depth) for w in self.writers]
+        self.errors = [None] * len(self.writers)
+        self.scratch = None
+        self.threads = [threading.Thread(target=self.feed, args=(i,)) 
+                        for i in xrange(len(self.writers))]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+    
+    def feed(self, i):
+        writer, queue = self.writers[i], self.queues[i]
+        for frames in iter(queue.get, None):
+            if self.errors[i] is None:
+                try:
+                    writer.write_frames(frames)
+                except Exception as e:
+                    # Keep draining so the other encoders aren't held up.
+                    self.errors[i] = e
+    
+    def write(self, piece):
+        n = len(piece.data)
+        if self.scratch is None or len(self.scratch) < n:
+            self.scratch = empty((n, 2), dtype=int16)
+        with span('encode', 'encode', outputs=len(self.writers)) as result:
+            frames = pcm_bytes(piece, self.scratch)
+            for queue in self.queues:
+                queue.put(frames)
+            result['data'] = piece.data
+    
+    def finish(self):
+        for queue in self.queues:
+            queue.put(None)
+        for t in self.threads:
+            t.join()
+    
+    def close(self):
+        """Waits for every encoder and returns the filenames, in order."""
+        self.finish()
+        failed = []
+        for writer, error in zip(self.writers, self.errors):
+            try:
+                writer.close()
+            except (RuntimeError, IOError):
+                failed.append(writer.filename)
+            else:
+                if error is not None:
+                    failed.append(writer.filename)
+        if failed:
+            raise RuntimeError("Encoding %s failed" % ', '.join(failed))
+        return [writer.filename for writer in self.writers]
+    
+    def kill(self):
+        for writer in self.writers:
+            writer.kill()
+        self.finish()
+
+
+def stream_render(actions, filename, verbose=True, bitRate=128, 
+                  parallel=False, processes=None, cache=None):
+    """Renders each action in turn straight into the encoder. Memory is 
+    bounded by the largest single action rather than the whole mix."""
+    writer = PCMWriter(filename, bitRate=bitRate, verbose=verbose)
+    return _stream(writer, actions, parallel, processes, cache)
+
+
+def fanout_render(actions, outputs, verbose=True, parallel=False, 
+                  processes=None, cache=None):
+    """Renders actions once and encodes them to every (filename, bitRate) 
+    in outputs at the same time. Returns the filenames."""
+    writer = FanoutWriter(outputs, verbose=verbose)
+    return _stream(writer, actions, parallel, processes, cache)
+
+
+def _stream(writer, actions, parallel, processes, cache):
+    try:
+        for piece in render_pieces(actions, parallel, processes, cache):
+            writer.write(piece)
+            release(piece)
+    except:
+        writer.kill()
+        raise
+    return writer.close()
 
 
 class Playback(object):
@@ -76,10 +414,11 @@ class Playback(object):
         # self has start and duration, so it is a valid index into track.
         output = self.track[self]
         # Normalize volume if necessary
-        gain = getattr(self.track, 'gain', None)
-        if gain != None:
-            # limit expects a float32 vector
-            output.data = limit(multiply(output.data, float32(gain)))
+        gain = track_gain(self.track)
+        if gain != 1:
+            # output.data is a view of the track, so scale into a pooled 
+            # float32 buffer, which stays float32 through to the encoder.
+            output.data = output.pool_buffer = apply_gain(output.data, gain)
             
         return output
     
@@ -93,12 +432,18 @@ class Playback(object):
 
 
 class Fadeout(Playback):
-    """Fadeout"""
+    """Fadeout, with a curve from fades.MODES"""
+    def __init__(self, track, start, duration, mode='linear'):
+        Playback.__init__(self, track, start, duration)
+        self.mode = mode
+    
     def render(self):
-        gain = getattr(self.track, 'gain', 1.0)
-        output = self.track[self]
-        # second parameter is optional -- in place function for now
-        output.data = fadeout(output.data, gain)
+        gain = track_gain(self.track)
+        output = make_stereo(self.track[self])
+        # output.data is a view of the track, so fade into a pooled buffer.
+        vecout = fades.fade_out(output.data, self.mode, gain, 
+                                out=buffers.take(output.data.shape))
+        output.data = output.pool_buffer = clip(vecout, -32767, 32767, out=vecout)
         return output
     
     def __repr__(self):
@@ -111,12 +456,18 @@ class Fadeout(Playback):
 
 
 class Fadein(Playback):
-    """Fadein"""
+    """Fadein, with a curve from fades.MODES"""
+    def __init__(self, track, start, duration, mode='linear'):
+        Playback.__init__(self, track, start, duration)
+        self.mode = mode
+    
     def render(self):
-        gain = getattr(self.track, 'gain', 1.0)
-        output = self.track[self]
-        # second parameter is optional -- in place function for now
-        output.data = fadein(output.data, gain)
+        gain = track_gain(self.track)
+        output = make_stereo(self.track[self])
+        # output.data is a view of the track, so fade into a pooled buffer.
+        vecout = fades.fade_in(output.data, self.mode, gain, 
+                               out=buffers.take(output.data.shape))
+        output.data = output.pool_buffer = clip(vecout, -32767, 32767, out=vecout)
         return output
     
     def __repr__(self):
@@ -157,12 +508,8 @@ class Crossfade(object):
         self.mode = mode
     
     def render(self):
-        t1, t2 = map(make_stereo, (self.t1.get(), self.t2.get()))
-        vecout = crossfade(t1.data, t2.data, self.mode)
-        audio_out = AudioData(ndarray=vecout, shape=vecout.shape, 
-                                sampleRate=t1.sampleRate, 
-                                numChannels=vecout.shape[1])
-        return audio_out
+        gains = (track_gain(self.t1.track), track_gain(self.t2.track))
+        return crossfade_pieces(self.t1.get(), self.t2.get(), self.mode, gains)
     
     def __repr__(self):
         args = (self.t1.track.filename, self.t2.track.filename)
@@ -203,6 +550,11 @@ class Jump(Crossfade):
 
 class Blend(object):
     """Mix together two lists of beats"""
+    # Name of the timestretch backend to use; None picks the default.
+    backend = None
+    # Scale applied to the sum of the two tracks, so that it rarely clips.
+    headroom = 0.5 ** 0.5
+    
     def __init__(self, tracks, lists):
         self.t1, self.t2 = tracks
         self.l1, self.l2 = lists
@@ -215,11 +567,82 @@ class Blend(object):
         self.durations = [(d1 + d2) / 2.0 for ((s1, d1), (s2, d2)) in zipped]
         self.duration = sum(self.durations)
     
+    @property
+    def stretch_backend(self):
+        """The timestretch backend stretch() uses."""
+        return self.backend or timestretch.default_backend()
+    
+    def stretch(self, t, l):
+        """t is a track, l is a list. t's gain is not applied: the caller 
+        applies it in the same pass as it mixes the stretched tracks."""
+        signal_start = int(l[0][0] * t.sampleRate)
+        signal_duration = int((sum(l[-1]) - l[0][0]) * t.sampleRate)
+        
+        # One (offset, factor) per beat, for a single time_scale call.
+        starts, durations = array(l, dtype=float64).T
+        offsets = (starts * t.sampleRate).astype(int) - signal_start
+        factors = array(self.durations, dtype=float64) / durations
+        rates = list(zip(offsets.tolist(), factors.tolist()))
+        
+        backend = self.stretch_backend
+        cache = timestretch.cache
+        key = None
+        identity = track_identity(t)
+        if cache is not None and identity is not None:
+            key = ('stretch', identity, signal_start, signal_duration, tuple(rates), 
+                   backend)
+            audio_out = cache.get(key)
+            if audio_out is not None:
+                return audio_out
+        
+        if hasattr(t, 'samples'):
+            # Decodes only the span being stretched.
+            vecin = t.samples(signal_start, signal_start + signal_duration)
+        else:
+            vecin = t.data[signal_start:signal_start + signal_duration,:]
+        with span('stretch', 'stretch', backend=backend) as result:
+            vecout = result['data'] = timestretch.time_scale(vecin, rates, t.sampleRate, 
+                                                             0, backend)
+        audio_out = AudioData(ndarray=vecout, shape=vecout.shape, 
+                                sampleRate=t.sampleRate, 
+                                numChannels=vecout.shape[1])
+        if key is not None:
+            cache.put(key, audio_out)
+        return audio_out
+    
+    def stretch_both(self):
+        """Stretches each list to self.durations; returns the two AudioDatas.
+        The two stretches are independent, and dirac and numpy.fft release 
+        the GIL while they work, so t2's runs on a second thread."""
+        pool = ThreadPool(1)
+        try:
+            pending = pool.apply_async(self.stretch, (self.t2, self.l2))
+            out1 = self.stretch(self.t1, self.l1)
+            out2 = pending.get()
+        finally:
+            pool.close()
+        return make_stereo(out1), make_stereo(out2)
+    
+    def gains(self):
+        return (track_gain(self.t1), track_gain(self.t2))
+    
+    def frames(self, piece):
+        """Frames of piece in self.duration, rounded as slicing it would be."""
+        return int(self.duration * piece.sampleRate)
+    
     def render(self):
-        # use self.durations already computed
-        # build 2 AudioQuantums
-        # call Mix
-        pass
+        # Each track is stretched beat by beat to self.durations in a single 
+        # time_scale call, then the two are scaled by their gains and the 
+        # headroom as they are summed into one pooled buffer.
+        out1, out2 = self.stretch_both()
+        n = min(len(out1.data), len(out2.data))
+        gains = [gain * self.headroom for gain in self.gains()]
+        vecout = fades.mix(out1.data[:n], out2.data[:n], gains, out=buffers.take((n, 2)))
+        clip(vecout, -32767, 32767, out=vecout)
+        audio_out = AudioData(ndarray=vecout, shape=vecout.shape, 
+                                sampleRate=out1.sampleRate, numChannels=2)
+        audio_out.pool_buffer = vecout
+        return audio_out
     
     def __repr__(self):
         args = (self.t1.filename, self.t2.filename)
@@ -235,21 +658,16 @@ class Blend(object):
 
         
 class Mix(Blend):
-    """Mix together two lists of beats"""
-    def __init__(self):
-        super(Blend, self).__init__()
-        print 'I am initialized'
-        
+    """Mix together two lists of beats, crossfading from the first to the 
+    second with the given mode."""
+    def __init__(self, tracks, lists, mode='linear'):
+        Blend.__init__(self, tracks, lists)
+        self.mode = mode
+    
     def render(self):
-        t1, t2 = self.t1, self.t2
-        print(dir(t1))
-        vecout = crossfade(t1.data, t2.data, self.mode)
-        audio_out = AudioData(ndarray=vecout, shape=vecout.shape, 
-                                sampleRate=t1.sampleRate, 
-                                numChannels=vecout.shape[1])
-        return audio_out
+        out1, out2 = self.stretch_both()
+        return crossfade_pieces(out1, out2, self.mode, self.gains(), self.frames(out1))
     
-        
     def __repr__(self):
         args = (self.t1.filename, self.t2.filename)
         return "<Mix '%s' and '%s'>" % args
@@ -264,6 +682,7 @@ class Mix(Blend):
 
 class Crossmatch(Blend):
     """Makes a beat-matched crossfade between the two input tracks."""
+    
     def calculate_durations(self):
         c, dec = 1.0, 1.0 / float(len(self.l1)+1)
         self.durations = []
@@ -272,40 +691,16 @@ class Crossmatch(Blend):
             self.durations.append(c * d1 + (1 - c) * d2)
         self.duration = sum(self.durations)
     
-    def stretch(self, t, l):
-        """t is a track, l is a list"""
-        signal_start = int(l[0][0] * t.sampleRate)
-        signal_duration = int((sum(l[-1]) - l[0][0]) * t.sampleRate)
-        vecin = t.data[signal_start:signal_start + signal_duration,:]
-        
-        rates = []
-        for i in xrange(len(l)):
-            rate = (int(l[i][0] * t.sampleRate) - signal_start, 
-                    self.durations[i] / l[i][1])
-            rates.append(rate)
-        
-        vecout = dirac.timeScale(vecin, rates, t.sampleRate, 0)
-        if hasattr(t, 'gain'):
-            vecout = limit(multiply(vecout, float32(t.gain)))
-        
-        audio_out = AudioData(ndarray=vecout, shape=vecout.shape, 
-                                sampleRate=t.sampleRate, 
-                                numChannels=vecout.shape[1])
-        return audio_out
-    
     def render(self):
         # use self.durations already computed
         # 1) stretch the duration of each item in t1 and t2
         # to the duration prescribed in durations.
-        out1 = self.stretch(self.t1, self.l1)
-        out2 = self.stretch(self.t2, self.l2)
+        out1, out2 = self.stretch_both()
         
-        # 2) cross-fade the results
-        # out1.duration, out2.duration, and self.duration should be about 
-        # the same, but it never hurts to be safe.
-        duration = min(out1.duration, out2.duration, self.duration)
-        c = Crossfade([out1, out2], [0, 0], duration, mode='equal_power')
-        return c.render()
+        # 2) cross-fade the results, applying the tracks' gains as it goes.
+        # out1, out2 and self.duration should be about the same length, but 
+        # crossfade_pieces only uses what they share.
+        return crossfade_pieces(out1, out2, 'equal_power', self.gains(), self.frames(out1))
     
     def __repr__(self):
         args = (self.t1.filename, self.t2.filename)
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# encoding: utf=8
+"""
+analysis_store.py
+
+Versioned binary storage for analyses, replacing pickled .en files.
+
+A store file sits next to its mp3 as <name>.mp3.analysis.npz. It is an
+uncompressed npz holding a JSON header (format, version, audio filename,
+scalar analysis fields) and one array per column of each rate level.
+Opening one only reads the zip directory and header; each rate level is
+read the first time it is used, and no file is held open in between. The
+header also carries the track's annotations (see annotations.py), so the
+transition helpers don't need any level to be read. Loading never unpickles
+anything.
+
+Convert existing pickles with:
+    analysis_store.convert_all('audio/')
+
+A StoredTrack decodes audio on demand. Slicing it (track[edit], as the
+actions do) decodes only the CHUNK_SECONDS chunks the slice covers, with
+ffmpeg seeking to each one. Decoded chunks are shared through chunks, a
+bounded LRU. Only .data decodes the whole file.
+"""
+import os
+import glob
+import json
+import pickle
+import threading
+import subprocess
+from collections import OrderedDict
+
+import numpy as np
+import echonest.remix.audio as audio
+from columnar import ColumnarAnalysis, QuantumArray, RATES
+from annotations import Annotations, annotate
+from action import find_ffmpeg
+from render_trace import span
+from render_cache import file_identity
+
+FORMAT = 'remix-analysis'
+FORMAT_VERSION = 1
+EXTENSION = '.analysis.npz'
+PICKLE_EXTENSION = '.analysis.en'
+CHUNK_SECONDS = 10
+
+
+def store_path(filename):
+    """Return the store file path for an audio file or its .en pickle."""
+    if filename.endswith(PICKLE_EXTENSION):
+        filename = filename[:-len(PICKLE_EXTENSION)]
+    return filename + EXTENSION
+
+
+def _plain(value):
+    """json.dumps fallback for numpy scalars."""
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+def write(analysis, path, filename=None, sampleRate=44100, numChannels=2):
+    """Write a ColumnarAnalysis (or an AudioAnalysis, converted first) to path."""
+    if not isinstance(analysis, ColumnarAnalysis):
+        analysis = ColumnarAnalysis.from_analysis(analysis)
+    arrays = {}
+    for kind in RATES:
+        if kind in analysis.levels:
+            for name, values in analysis.level(kind).columns.items():
+                arrays['%s.%s' % (kind, name)] = values
+    header = {'format': FORMAT, 'version': FORMAT_VERSION, 'filename': filename,
+              'sampleRate': sampleRate, 'numChannels': numChannels,
+              'scalars': analysis.scalars(), 'annotations': annotate(analysis).to_dict()}
+    arrays['header'] = np.frombuffer(json.dumps(header, default=_plain).encode('utf-8'),
+                                     dtype=np.uint8)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+    os.rename(tmp, path)
+    return path
+
+
+def _level_loader(path, kind, keys):
+    def load():
+        # Opened only for the read, so a library of tracks holds no files open.
+        with np.load(path, allow_pickle=False) as store:
+            columns = dict((key.split('.', 1)[1], store[key]) for key in keys)
+        return QuantumArray(columns, kind)
+    return load
+
+
+def read(path):
+    """
+    Open a store file and return (header, analysis). Rate levels are read
+    from the file when first used.
+    """
+    with np.load(path, allow_pickle=False) as store:
+        header = json.loads(bytearray(store['header']).decode('utf-8'))
+        files = store.files
+    if header.get('format') != FORMAT:
+        raise ValueError("%s is not an analysis store file" % path)
+    if header.get('version', 0) > FORMAT_VERSION:
+        raise ValueError("%s has format version %s, newer than %d" %
+                         (path, header.get('version'), FORMAT_VERSION))
+    levels = {}
+    for kind in RATES:
+        keys = [key for key in files if key.startswith(kind + '.')]
+        if keys:
+            levels[kind] = _level_loader(path, kind, keys)
+    analysis = ColumnarAnalysis(levels, header['scalars'])
+    notes = Annotations.from_dict(header.get('annotations'))
+    if notes is not None:
+        analysis.annotations = notes
+    return header, analysis
+
+
+def decode_range(filename, start, duration, sampleRate=44100, numChannels=2):
+    """Decode duration seconds of filename from start seconds, as int16 frames."""
+    command = [find_ffmpeg(), '-ss', '%.6f' % start, '-i', filename, '-t', '%.6f' % duration,
+               '-f', 's16le', '-ar', str(sampleRate), '-ac', str(numChannels), '-']
+    with span('decode', 'decode', filename=filename, start=start) as result:
+        with open(os.devnull, 'w') as devnull:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=devnull)
+            raw = process.communicate()[0]
+        if process.returncode != 0:
+            raise RuntimeError("Decoding %s failed" % filename)
+        data = result['data'] = np.frombuffer(raw, dtype=np.int16).reshape(-1, numChannels)
+    return data
+
+
+class ChunkCache(object):
+    """
+    Bounded LRU of decoded chunks, keyed by the file's (name, size, mtime),
+    sampleRate, numChannels and chunk index, so a file replaced in place isn't
+    served from its old chunks. Threads asking for a chunk that is already being decoded wait for that
+    decode instead of starting another.
+    """
+    def __init__(self, max_bytes=128 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.decoding = {}
+        self.bytes = 0
+        self.decodes = 0
+        self.lock = threading.Lock()
+
+    def get(self, filename, index, sampleRate, numChannels, duration=None):
+        """
+        Chunk index of filename, CHUNK_SECONDS long. Only a chunk reaching
+        duration seconds (the end of the track, when known) may be shorter.
+        """
+        key = (file_identity(filename) or filename, sampleRate, numChannels, index)
+        with self.lock:
+            chunk = self.entries.pop(key, None)
+            if chunk is not None:
+                self.entries[key] = chunk
+                return chunk
+            event = self.decoding.get(key)
+            owner = event is None
+            if owner:
+                event = self.decoding[key] = threading.Event()
+        if not owner:
+            event.wait()
+            # Decoded meanwhile, unless it failed or was already evicted.
+            return self.get(filename, index, sampleRate, numChannels, duration)
+        try:
+            frames = CHUNK_SECONDS * sampleRate
+            chunk = decode_range(filename, index * CHUNK_SECONDS, CHUNK_SECONDS,
+                                 sampleRate, numChannels)
+            # Seeking can be a few frames off either way; chunks must tile 
+            # exactly, so that later ones stay in time with the analysis.
+            if len(chunk) > frames:
+                chunk = chunk[:frames]
+            elif len(chunk) < frames and duration is not None and \
+                    (index + 1) * CHUNK_SECONDS < duration:
+                padding = np.zeros((frames - len(chunk), numChannels), dtype=chunk.dtype)
+                chunk = np.concatenate((chunk, padding))
+            with self.lock:
+                self.decodes += 1
+                self.entries[key] = chunk
+                self.bytes += chunk.nbytes
+                while self.bytes > self.max_bytes and len(self.entries) > 1:
+                    k, evicted = self.entries.popitem(last=False)
+                    self.bytes -= evicted.nbytes
+            return chunk
+        finally:
+            with self.lock:
+                del self.decoding[key]
+            event.set()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+chunks = ChunkCache()
+
+
+class StoredTrack(object):
+    """
+    A track restored from a store file. The analysis comes from the store;
+    audio is decoded from the original file a chunk at a time as slices of
+    it are used, or all at once the first time .data is used.
+    """
+    def __init__(self, filename, analysis, sampleRate=44100, numChannels=2):
+        self.filename = filename
+        self.analysis = analysis
+        self.sampleRate = sampleRate
+        self.numChannels = numChannels
+        self._audio = None
+        self._audio_lock = threading.Lock()
+
+    @property
+    def audio(self):
+        if self._audio is None:
+            with self._audio_lock:
+                # Another thread may have decoded it while this one waited.
+                if self._audio is None:
+                    with span('decode', 'decode', filename=self.filename) as result:
+                        decoded = audio.AudioData(self.filename, sampleRate=self.sampleRate,
+                                                  numChannels=self.numChannels, verbose=False)
+                        result['data'] = decoded.data
+                    self._audio = decoded
+        return self._audio
+
+    @property
+    def data(self):
+        return self.audio.data
+
+    @property
+    def duration(self):
+        return self.analysis.duration
+
+    def samples(self, start, stop):
+        """Frames start to stop, decoding only the chunks they fall in."""
+        if self._audio is not None:
+            return self._audio.data[start:stop]
+        size = CHUNK_SECONDS * self.sampleRate
+        start, stop = max(start, 0), max(stop, start)
+        pieces = []
+        for index in xrange(start // size, (stop - 1) // size + 1 if stop > start else 0):
+            chunk = chunks.get(self.filename, index, self.sampleRate, self.numChannels,
+                               self.duration)
+            pieces.append(chunk[max(start - index * size, 0):stop - index * size])
+            if len(chunk) < size:
+                break  # the end of the track
+        if len(pieces) == 1:
+            return pieces[0]
+        if not pieces:
+            return np.zeros((0, self.numChannels), dtype=np.int16)
+        return np.concatenate(pieces)
+
+    def __getitem__(self, index):
+        if self._audio is not None or not hasattr(index, 'duration'):
+            return self.audio[index]
+        # An edit or quantum: decode just its span, rounded as AudioData does.
+        start = int(index.start * self.sampleRate)
+        stop = int((index.start + index.duration) * self.sampleRate)
+        data = self.samples(start, stop)
+        return audio.AudioData(ndarray=data, shape=data.shape, sampleRate=self.sampleRate,
+                               numChannels=self.numChannels)
+
+    def __repr__(self):
+        return "<StoredTrack '%s'>" % self.filename
+
+
+def load_track(path):
+    """Return a StoredTrack for a store file."""
+    header, analysis = read(path)
+    filename = header['filename']
+    if filename and not os.path.exists(filename):
+        # Stored relative to wherever it was converted; look beside the store.
+        beside = os.path.join(os.path.dirname(path), os.path.basename(filename))
+        if os.path.exists(beside):
+            filename = beside
+    return StoredTrack(filename, analysis, header['sampleRate'], header['numChannels'])
+
+
+def save_track(track, path=None):
+    """Write the analysis of a LocalAudioFile (or StoredTrack) to its store file."""
+    path = path or store_path(track.filename)
+    return write(track.analysis, path, track.filename,
+                 getattr(track, 'sampleRate', 44100), getattr(track, 'numChannels', 2))
+
+
+def convert(en_path, path=None):
+    """Convert a pickled .en LocalAudioFile to a store file and return its path."""
+    with open(en_path, 'rb') as f:
+        track = pickle.load(f)
+    return save_track(track, path or store_path(en_path))
+
+
+def convert_all(directory='audio/'):
+    """Convert every .en pickle in directory that has no up to date store file."""
+    converted = []
+    for en_path in glob.glob(os.path.join(directory, '*' + PICKLE_EXTENSION)):
+        path = store_path(en_path)
+        if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(en_path):
+            converted.append(convert(en_path, path))
+    return converted
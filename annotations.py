@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# encoding: utf=8
+"""
+annotations.py
+
+Per-track facts that the transition helpers used to recompute on every
+call: where the audible part of the track begins and ends, which members of
+each rate level lie between the fade in and fade out, average tatum and
+beat durations, and the lead-in before the first beat.
+
+They depend only on the analysis, so they are computed once and kept on it
+as analysis.annotations. analysis_store saves them in the store header, so
+tracks loaded from a store have them without reading any rate level:
+
+    notes = annotations.annotate(track.analysis)
+    notes.first_viable_time, notes.central['beats']
+"""
+import math
+
+import numpy as np
+
+from columnar import column, RATES
+
+VERSION = 1
+VIABLE_LOUDNESS = -60
+TAIL_TATUMS = 16
+TAIL_SEGMENTS = 8
+HEAD_BEATS = 8
+
+FIELDS = ('first_viable', 'last_viable', 'first_viable_time', 'last_viable_time',
+          'central', 'tatum_duration', 'beat_duration', 'lead_in')
+
+
+def _average(durations, count):
+    # Divides by count even when there are fewer, as the helpers always have.
+    return float(np.sum(durations)) / count
+
+
+class Annotations(object):
+    """
+    first_viable, last_viable    indices of the first and last segments
+                                 louder than VIABLE_LOUDNESS, or None
+    first_viable_time            start of the first of those, in seconds
+    last_viable_time             end of the last of those, in seconds
+    central                      {rate: (start, stop)} index range of the
+                                 members between end_of_fade_in and
+                                 start_of_fade_out
+    tatum_duration               average of the last TAIL_TATUMS tatums (the
+                                 last TAIL_SEGMENTS segments if no tatums)
+    beat_duration                average of the first HEAD_BEATS beats
+    lead_in                      time of the first beat extended back by
+                                 whole beats until it is at or before 0
+    """
+    def __init__(self, **fields):
+        self.version = fields.pop('version', VERSION)
+        for name in FIELDS:
+            setattr(self, name, fields.get(name))
+        self.central = dict((rate, tuple(span)) for rate, span in (self.central or {}).items())
+
+    @classmethod
+    def from_analysis(cls, analysis):
+        segments = analysis.segments
+        loudness = column(segments, 'loudness_max')
+        viable = np.flatnonzero(loudness > VIABLE_LOUDNESS)
+        fields = {}
+        if len(viable):
+            first, last = int(viable[0]), int(viable[-1])
+            fields['first_viable'], fields['last_viable'] = first, last
+            fields['first_viable_time'] = float(column(segments, 'start')[first])
+            fields['last_viable_time'] = float(column(segments, 'end')[last])
+
+        central = {}
+        for rate in RATES:
+            members = getattr(analysis, rate, None)
+            if members is None:
+                continue
+            start = column(members, 'start')
+            inside = np.flatnonzero((analysis.end_of_fade_in <= start) &
+                                    (start + column(members, 'duration') <
+                                     analysis.start_of_fade_out))
+            # Members are sorted and don't overlap, so the central ones are contiguous.
+            central[rate] = (int(inside[0]), int(inside[-1]) + 1) if len(inside) else (0, 0)
+        fields['central'] = central
+
+        tatums = column(analysis.tatums, 'duration')
+        if len(tatums):
+            fields['tatum_duration'] = _average(tatums[-TAIL_TATUMS:], TAIL_TATUMS)
+        else:
+            fields['tatum_duration'] = _average(column(segments, 'duration')[-TAIL_SEGMENTS:],
+                                                TAIL_SEGMENTS)
+
+        beats = analysis.beats
+        beat_duration = _average(column(beats, 'duration')[:HEAD_BEATS], HEAD_BEATS)
+        fields['beat_duration'] = beat_duration
+        if len(beats):
+            earliest = float(column(beats, 'start')[0])
+        elif len(segments):
+            earliest = float(column(segments, 'start')[0])
+        else:
+            earliest = 0.0
+        if earliest > 0 and beat_duration > 0:
+            earliest -= math.ceil(earliest / beat_duration) * beat_duration
+        fields['lead_in'] = earliest
+        return cls(**fields)
+
+    def to_dict(self):
+        fields = dict((name, getattr(self, name)) for name in FIELDS)
+        fields['central'] = dict((rate, list(span)) for rate, span in self.central.items())
+        fields['version'] = self.version
+        return fields
+
+    @classmethod
+    def from_dict(cls, fields):
+        """Return Annotations from to_dict() output, or None if they are out of date."""
+        if not fields or fields.get('version') != VERSION:
+            return None
+        return cls(**fields)
+
+    def __repr__(self):
+        return "<Annotations first %r last %r lead-in %.3f>" % (
+            self.first_viable_time, self.last_viable_time, self.lead_in)
+
+
+def annotate(analysis):
+    """Return analysis.annotations, computing and attaching them the first time."""
+    notes = getattr(analysis, 'annotations', None)
+    if not isinstance(notes, Annotations):
+        notes = Annotations.from_analysis(analysis)
+        analysis.annotations = notes
+    return notes
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# encoding: utf=8
+"""
+bench_capsule.py
+
+Micro-benchmarks for the capsule_support hot paths, run on synthetic
+Echonest-like analyses, so no audio files or network are needed.
+
+Each function is timed on tracks of several lengths. The report shows the
+best time per call at each length and a scaling exponent: 1.0 means time
+grows linearly with track length. Results can be saved as a JSON baseline
+and later runs compared against it.
+"""
+from __future__ import print_function
+import sys
+import json
+import time
+import platform
+import argparse
+
+import numpy as np
+
+from columnar import QuantumArray, ColumnarAnalysis
+from capsule_support import (align, resample_features, timbre_whiten, upsample_list,
+                             upsample_window, sliding_distances, move_cursor, get_mean_offset,
+                             get_central)
+
+usage = """
+Usage:
+    python bench_capsule.py [--lengths 60 240 600] [--save baseline.json]
+    python bench_capsule.py --compare baseline.json [--threshold 1.25]
+
+Example:
+    python bench_capsule.py --save bench/baseline.json
+    python bench_capsule.py --compare bench/baseline.json
+"""
+
+LENGTHS = (60, 240, 600)
+TEMPO = 120.0
+MIN_TIME = 0.05
+REPEAT = 5
+THRESHOLD = 1.25
+
+
+def _level(starts, end, kind, extra=None):
+    durations = np.diff(np.append(starts, end))
+    columns = {'start': starts, 'duration': durations,
+               'confidence': np.ones(len(starts))}
+    columns.update(extra or {})
+    return QuantumArray(columns, kind)
+
+
+def synthetic_analysis(seconds, tempo=TEMPO, seed=0):
+    """
+    A ColumnarAnalysis shaped like the analyzer's: segments of 80-500ms with
+    random timbre, pitches and loudness, a slightly jittered beat grid at
+    tempo, two tatums per beat, four beats per bar and 32 bars per section.
+    """
+    rng = np.random.RandomState(seed)
+    beat = 60.0 / tempo
+    beats = np.arange(0.2, seconds - beat, beat)
+    beats[1:] += rng.normal(0, 0.004, len(beats) - 1)
+    tatums = np.sort(np.concatenate((beats, beats + beat / 2)))
+
+    lengths = rng.uniform(0.08, 0.5, int(seconds / 0.08) + 1)
+    segments = np.concatenate(([0], np.cumsum(lengths)))
+    segments = segments[segments < seconds]
+    n = len(segments)
+    timbre = rng.normal(0, 40, (n, 12)).astype(np.float32)
+    timbre[:, 0] = rng.normal(45, 5, n)
+    loudness = rng.normal(-20, 5, n)
+    # Silence at both ends, as first_viable and last_viable expect.
+    loudness[:2] = loudness[-2:] = -70
+    durations = np.diff(np.append(segments, seconds))
+    segment_columns = {
+        'loudness_begin': loudness - rng.uniform(3, 10, n),
+        'loudness_max': loudness,
+        'time_loudness_max': durations * rng.uniform(0, 0.5, n),
+        'loudness_end': loudness - rng.uniform(3, 10, n),
+        'timbre': timbre,
+        'pitches': rng.uniform(0, 1, (n, 12)).astype(np.float32),
+    }
+    levels = {
+        'segments': _level(segments, seconds, 'segments', segment_columns),
+        'tatums': _level(tatums, seconds, 'tatums'),
+        'beats': _level(beats, seconds, 'beats'),
+        'bars': _level(beats[::4], seconds, 'bars'),
+        'sections': _level(beats[::128], seconds, 'sections'),
+    }
+    scalars = {'duration': float(seconds), 'loudness': -10.0, 'tempo': tempo, 'key': 0,
+               'mode': 1, 'time_signature': 4, 'end_of_fade_in': 1.0,
+               'start_of_fade_out': seconds - 3.0}
+    return ColumnarAnalysis(levels, scalars)
+
+
+class SyntheticTrack(object):
+    """Enough of a LocalAudioFile for the capsule_support planning functions."""
+    def __init__(self, seconds, seed=0):
+        self.filename = 'synthetic-%ds-%d' % (seconds, seed)
+        self.analysis = synthetic_analysis(seconds, seed=seed)
+        self.duration = float(seconds)
+
+    def resample(self, rate='beats'):
+        self.resampled = resample_features(self, rate=rate)
+        self.resampled['matrix'] = timbre_whiten(self.resampled['matrix'])
+        return self
+
+
+# Each case takes the seconds of track to build and returns the call to time.
+
+def case_resample_features(seconds):
+    track = SyntheticTrack(seconds)
+    return lambda: resample_features(track, rate='tatums')
+
+
+def case_timbre_whiten(seconds):
+    mat = resample_features(SyntheticTrack(seconds), rate='tatums')['matrix']
+    return lambda: timbre_whiten(mat)
+
+
+def case_get_mean_offset(seconds):
+    analysis = SyntheticTrack(seconds).analysis
+    segments, markers = get_central(analysis, 'segments')[0], get_central(analysis, 'beats')[0]
+    return lambda: get_mean_offset(segments, markers)
+
+
+def case_align(seconds):
+    track1 = SyntheticTrack(seconds, seed=1).resample()
+    track2 = SyntheticTrack(seconds, seed=2).resample()
+    mat1, mat2 = track1.resampled['matrix'][:16], track2.resampled['matrix']
+    return lambda: align(track1, track2, mat1, mat2)
+
+
+def case_move_cursor(seconds):
+    track = SyntheticTrack(seconds).resample()
+    return lambda: move_cursor(track, seconds / 2.0, 0)
+
+
+def case_sliding_distances(seconds):
+    track1 = SyntheticTrack(seconds, seed=1).resample()
+    track2 = SyntheticTrack(seconds, seed=2).resample()
+    mat1, mat2 = track1.resampled['matrix'][:16], track2.resampled['matrix']
+    return lambda: sliding_distances(mat1, mat2)
+
+
+def case_upsample_window(seconds):
+    # The window make_crossmatch reads: 32 upsampled beats from mid-track.
+    beats = SyntheticTrack(seconds).analysis.beats
+    return lambda: upsample_window(beats, 2, len(beats), 32)
+
+
+CASES = [('resample_features', case_resample_features),
+         ('timbre_whiten', case_timbre_whiten),
+         ('get_mean_offset', case_get_mean_offset),
+         ('align', case_align),
+         ('move_cursor', case_move_cursor),
+         ('sliding_distances', case_sliding_distances),
+         ('upsample_window', case_upsample_window)]
+
+
+def check(seconds=60):
+    """Fail fast if a benchmarked function breaks on the columnar analysis."""
+    beats = synthetic_analysis(seconds).beats
+    upsampled = upsample_list(beats, 2)
+    starts, durations = beats.column('start'), beats.column('duration')
+    assert len(upsampled) == 2 * len(beats)
+    assert np.allclose([s for s, d in upsampled[::2]], starts)
+    assert np.allclose([s for s, d in upsampled[1::2]], starts + durations / 2)
+    assert np.allclose([d for s, d in upsampled], np.repeat(durations / 2, 2))
+
+
+def time_call(func, repeat=REPEAT, min_time=MIN_TIME):
+    """Best seconds per call over repeat runs, each looping for at least min_time."""
+    number = 1
+    while True:
+        start = time.time()
+        for i in xrange(number):
+            func()
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    best = elapsed
+    for r in xrange(repeat - 1):
+        start = time.time()
+        for i in xrange(number):
+            func()
+        best = min(best, time.time() - start)
+    return best / number
+
+
+def scaling(lengths, seconds):
+    """Exponent of the power law through (length, time) points."""
+    if len(lengths) < 2:
+        return None
+    return float(np.polyfit(np.log(lengths), np.log(seconds), 1)[0])
+
+
+def run(lengths=LENGTHS, names=None, repeat=REPEAT):
+    """Return {case: {'times': {length: seconds}, 'scaling': exponent}}."""
+    results = {}
+    for name, setup in CASES:
+        if names and name not in names:
+            continue
+        times = {}
+        for seconds in lengths:
+            times[str(seconds)] = time_call(setup(seconds), repeat)
+        results[name] = {'times': times,
+                         'scaling': scaling(lengths, [times[str(s)] for s in lengths])}
+    return results
+
+
+def baseline(results, lengths):
+    return {'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.platform(), 'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'lengths': list(lengths), 'results': results}
+
+
+def report(results, lengths, reference=None, threshold=THRESHOLD):
+    """Print a table of results, with ratios to reference; return the regressions."""
+    width = 12 if reference is None else 20
+    header = '%-20s' % 'function' + ''.join('%*s' % (width, '%ds' % s) for s in lengths) + \
+        '%9s' % 'scaling'
+    print(header)
+    print('-' * len(header))
+    regressions = []
+    for name, setup in CASES:
+        if name not in results:
+            continue
+        row = '%-20s' % name
+        for seconds in lengths:
+            t = results[name]['times'][str(seconds)]
+            cell = '%.3fms' % (t * 1000)
+            try:
+                ratio = t / reference[name]['times'][str(seconds)]
+            except (KeyError, TypeError):
+                pass
+            else:
+                cell += ' x%.2f' % ratio
+                if ratio > threshold:
+                    regressions.append((name, seconds, ratio))
+            row += '%*s' % (width, cell)
+        exponent = results[name]['scaling']
+        row += '%9s' % ('%.2f' % exponent if exponent is not None else '-')
+        print(row)
+    for name, seconds, ratio in regressions:
+        print("Regression: %s at %ds is %.2fx the baseline" % (name, seconds, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[1], usage=usage)
+    parser.add_argument('--lengths', type=int, nargs='+', default=list(LENGTHS),
+                        help='track lengths in seconds')
+    parser.add_argument('--only', nargs='+', help='functions to benchmark')
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--save', help='write results to this JSON baseline')
+    parser.add_argument('--compare', help='JSON baseline to compare against')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='slowdown ratio reported as a regression')
+    args = parser.parse_args(argv)
+
+    check()
+    results = run(args.lengths, args.only, args.repeat)
+    reference = None
+    if args.compare:
+        with open(args.compare) as f:
+            reference = json.load(f)['results']
+    regressions = report(results, args.lengths, reference, args.threshold)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(baseline(results, args.lengths), f, indent=2, sort_keys=True)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,10 +8,11 @@ Created by Tristan Jehan and Jason Sundram.
 """
 import logging
 import numpy as np
-from copy import deepcopy
 from action import Crossfade, Playback, Crossmatch, Fadein, Fadeout, humanize_time
-from utils import rows, flatten
+from utils import rows
 from append_support import abridge, trim_silence
+from columnar import column
+from annotations import annotate
 
 log = logging.getLogger(__name__)
 
@@ -41,54 +42,80 @@ def evaluate_distance(mat1, mat2):
 	return np.linalg.norm(mat1.flatten() - mat2.flatten())
 
 
-def upsample_matrix(m):
-	""" Upsample matrices by a factor of 2."""
-	r, c = m.shape
-	out = np.zeros((2 * r, c), dtype=np.float32)
-	for i in xrange(r):
-		out[i * 2    , :] = m[i, :]
-		out[i * 2 + 1, :] = m[i, :]
-	return out
+def sliding_distances(mat1, mat2, count=None):
+	""" Distances between mat1 and the first count windows of rows(mat1) rows in mat2.
+		Same values as evaluate_distance at every offset, computed all at once by
+		expanding |a - b|^2 = |a|^2 + |b|^2 - 2ab, with the cross terms as one
+		correlation per column.
+	"""
+	a = np.asarray(mat1, dtype=np.float64)
+	b = np.asarray(mat2, dtype=np.float64)
+	n = rows(a)
+	if count is None:
+		count = rows(b) - n + 1
+	cross = np.zeros(max(rows(b) - n + 1, 0))
+	for c in xrange(a.shape[1]):
+		cross += np.correlate(b[:, c], a[:, c], mode='valid')
+	# Squared norm of each window from a running sum of squared rows.
+	sq = np.concatenate(([0], np.cumsum((b * b).sum(1))))
+	d2 = (a * a).sum() + sq[n:n + count] - sq[:count] - 2 * cross[:count]
+	return np.sqrt(np.maximum(d2, 0))
+
+
+def upsample_matrix(m, rate=2):
+	""" Upsample matrices by an integer factor, repeating each row."""
+	return np.repeat(np.asarray(m, dtype=np.float32), rate, axis=0)
 
 
 def upsample_list(l, rate=2):
-	""" Upsample lists by a factor of 2."""
-	if rate != 2:
-		return l[:]
-	# Assume we're an AudioQuantumList.
+	""" (start, duration) tuples for every member of l upsampled by an integer factor.
+		Works on AudioQuantumLists and on the read-only columnar levels alike.
+	"""
+	rate = max(rate, 1)
+	return upsample_window(l, rate, 0, len(l) * rate)
 
-	def split(x):
-		a = deepcopy(x)
-		a.duration = x.duration / 2
-		b = deepcopy(a)
-		b.start = x.start + a.duration
-		return a, b
 
-	return flatten(map(split, l))
+def upsample_window(l, rate, start, count):
+	""" (start, duration) tuples for count markers from start in l upsampled by rate.
+		Only the members of l that fall in the window are read.
+	"""
+	first = start // rate
+	window = l[first:(start + count + rate - 1) // rate]
+	durations = column(window, 'duration') / float(rate)
+	starts = column(window, 'start')[:, np.newaxis] + durations[:, np.newaxis] * np.arange(rate)
+	offset = start - first * rate
+	starts = starts.ravel()[offset:offset + count]
+	durations = np.repeat(durations, rate)[offset:offset + count]
+	return zip(starts.tolist(), durations.tolist())
 
 
 def average_duration(l):
 	return sum([i.duration for i in l]) / float(len(l))
 
 
-def align(track1, track2, mat1, mat2):
+def adjustment_rates(tr1, tr2):
+	""" Upsampling rates for markers of durations tr1 and tr2, elementwise over arrays:
+		the side whose markers are more than half an octave longer is doubled.
+	"""
+	dist = np.log2(np.asarray(tr1, dtype=np.float64) / tr2)
+	return np.where(dist > 0.5, 2, 1), np.where(dist < -0.5, 2, 1)
+
+
+def get_adjustment(tr1, tr2):
+	"""Update tatum rate if necessary"""
+	rate1, rate2 = adjustment_rates(tr1, tr2)
+	return (int(rate1), int(rate2))
+
+
+def align(track1, track2, mat1, mat2, curve=False):
 	""" Constrained search between a settled section and a new section.
 		Outputs location in mat2 and the number of rows used in the transition.
+		With curve=True, also outputs the distance at every candidate location.
 	"""
 	# Get the average marker duration.
 	marker1 = average_duration(getattr(track1.analysis, track1.resampled['rate'])[track1.resampled['index']:track1.resampled['index'] + rows(mat1)])
 	marker2 = average_duration(getattr(track2.analysis, track2.resampled['rate'])[track2.resampled['index']:track2.resampled['index'] + rows(mat2)])
 
-	def get_adjustment(tr1, tr2):
-		"""Update tatum rate if necessary"""
-		dist = np.log2(tr1 / tr2)
-		if  dist < -0.5:
-			return (1, 2)
-		elif dist > 0.5:
-			return (2, 1)
-		else:
-			return (1, 1)
-
 	rate1, rate2 = get_adjustment(marker1, marker2)
 	if rate1 == 2:
 		mat1 = upsample_matrix(mat1)
@@ -100,15 +127,15 @@ def align(track1, track2, mat1, mat2):
 	rows1 = min(rows(mat1), max(rows2 - MIN_SEARCH, MIN_MARKERS))  # at least the best of MIN_SEARCH choices
 
 	# Search for minimum.
-	def dist(i):
-		return evaluate_distance(mat1[0:rows1, :], mat2[i:i + rows1, :])
-
-	min_loc = min(xrange(rows2 - rows1), key=dist)
+	distances = sliding_distances(mat1[0:rows1, :], mat2, rows2 - rows1)
+	min_loc = int(np.argmin(distances))
 
 	# Let's make sure track2 ends its transition on a regular tatum.
 	if rate2 == 2 and (min_loc + rows1) & 1:
 		rows1 -= 1
 
+	if curve:
+		return min_loc, rows1, rate1, rate2, distances
 	return min_loc, rows1, rate1, rate2
 
 
@@ -135,33 +162,25 @@ def get_central(analysis, member='segments'):
 		1) copy of the members (e.g. segments) between end_of_fade_in and start_of_fade_out.
 		2) the index of the first retained member.
 	"""
-	def central(s):
-		return analysis.end_of_fade_in <= s.start and (s.start + s.duration) < analysis.start_of_fade_out
-
 	members = getattr(analysis, member)  # this is nicer than data.__dict__[member]
-	ret = filter(central, members[:])
-	index = members.index(ret[0]) if ret else 0
-
-	return ret, index
+	start, stop = annotate(analysis).central[member]
+	return members[start:stop], start
 
 
 def get_mean_offset(segments, markers):
-	if segments == markers:
+	seg_start = column(segments, 'start')
+	mark_start = column(markers, 'start')
+	if len(seg_start) == len(mark_start) and np.array_equal(seg_start, mark_start):
 		return 0
 
-	index = 0
-	offsets = []
-	try:
-		for marker in markers:
-			while segments[index].start < marker.start + FUSION_INTERVAL:
-				offset = abs(marker.start - segments[index].start)
-				if offset < FUSION_INTERVAL:
-					offsets.append(offset)
-				index += 1
-	except IndexError:
-		pass
+	# Each segment is compared with the first marker it starts less than
+	# FUSION_INTERVAL after; segments past the last one are ignored.
+	owner = np.searchsorted(mark_start + FUSION_INTERVAL, seg_start, side='right')
+	valid = owner < len(mark_start)
+	offsets = np.abs(mark_start[owner[valid]] - seg_start[valid])
+	offsets = offsets[offsets < FUSION_INTERVAL]
 
-	return np.average(offsets) if offsets else AVG_PEAK_OFFSET
+	return np.average(offsets) if len(offsets) else AVG_PEAK_OFFSET
 
 
 def resample_features(data, rate='tatums', feature='timbre'):
@@ -179,40 +198,49 @@ def resample_features(data, rate='tatums', feature='timbre'):
 	if len(segments) < 2 or len(markers) < 2:
 		return ret
 
-	# Find the optimal attack offset
-	meanOffset = get_mean_offset(segments, markers)
-	tmp_markers = deepcopy(markers)
+	seg_start = column(segments, 'start')
+	seg_end = seg_start + column(segments, 'duration')
+	features = column(segments, feature)
 
-	# Apply the offset
-	for m in tmp_markers:
-		m.start -= meanOffset
-		if m.start < 0:
-			m.start = 0
+	# Find the optimal attack offset, and apply it
+	meanOffset = get_mean_offset(segments, markers)
+	mark_start = np.maximum(column(markers, 'start') - meanOffset, 0)
+	mark_dur = column(markers, 'duration')
 
 	# Allocate output matrix, give it alias mat for convenience.
-	mat = ret['matrix'] = np.zeros((len(tmp_markers) - 1, 12), dtype=np.float32)
+	mat = ret['matrix'] = np.zeros((len(markers) - 1, 12), dtype=np.float32)
+	n = rows(mat)
+	mark_start, mark_dur = mark_start[:n], mark_dur[:n]
+	mark_end = mark_start + mark_dur
 
 	# Find the index of the segment that corresponds to the first marker
-	f = lambda x: tmp_markers[0].start < x.start + x.duration
-	index = (i for i, x in enumerate(segments) if f(x)).next()
+	first = np.searchsorted(seg_end, mark_start[0], side='right')
+	if first == len(segments):
+		return ret
 
-	# Do the resampling
-	try:
-		for (i, m) in enumerate(tmp_markers):
-			while segments[index].start + segments[index].duration < m.start + m.duration:
-				dur = segments[index].duration
-				if segments[index].start < m.start:
-					dur -= m.start - segments[index].start
+	# Marker i covers segments lo[i] through hi[i], the first one ending at or after it;
+	# the last marker covers the same segment the next one starts on.
+	hi = np.maximum.accumulate(np.maximum(np.searchsorted(seg_end, mark_end), first))
+	lo = np.concatenate(([first], hi[:-1]))
 
-				C = min(dur / m.duration, 1)
+	# Markers running past the last segment get whatever it covers, those after nothing.
+	last = len(segments) - 1
+	n = min(np.searchsorted(hi, last, side='right') + 1, n)
+	lo, hi = lo[:n], hi[:n]
+	counts = np.minimum(hi, last) - lo + 1
 
-				mat[i, 0:12] += C * np.array(getattr(segments[index], feature))
-				index += 1
+	# Overlap weights, one per (marker, segment) pair, grouped by marker.
+	groups = np.cumsum(counts) - counts
+	pair_marker = np.repeat(np.arange(n), counts)
+	pair_segment = np.repeat(lo - groups, counts) + np.arange(counts.sum())
 
-			C = min((m.duration + m.start - segments[index].start) / m.duration, 1)
-			mat[i, 0:12] += C * np.array(getattr(segments[index], feature))
-	except IndexError:
-		pass  # avoid breaking with index > len(segments)
+	s, e, d = mark_start[pair_marker], mark_end[pair_marker], mark_dur[pair_marker]
+	overlap = np.where(pair_segment == hi[pair_marker],
+					   e - seg_start[pair_segment],
+					   seg_end[pair_segment] - np.maximum(seg_start[pair_segment], s))
+	weights = np.minimum(overlap / d, 1)
+
+	mat[:n] = np.add.reduceat(weights[:, np.newaxis] * features[pair_segment], groups, axis=0)
 
 	return ret
 
@@ -303,18 +331,12 @@ def make_crossfade(track1, track2, inter):
 	return [xf, pb]
 	
 def first_viable(track):
-	"""Iterate segs and return the index of first viable one."""
-	first = last = ''
-	for k, v in enumerate(track.analysis.segments):
-		if v.loudness_max > -60:
-			return k
+	"""Return the index of the first viable segment."""
+	return annotate(track.analysis).first_viable
 	
 def last_viable(track):
-	"""Iterate segs backwards and return the index of final viable one."""
-	for i in xrange(len(track.analysis.segments) - 1, -1, -1):
-		element = track.analysis.segments[i]
-		if element.loudness_max > -60: 
-			return i
+	"""Return the index of the final viable segment."""
+	return annotate(track.analysis).last_viable
 	
 def viable_duration(track, start_end):
 	"""Return the difference between start of start and end of end."""
@@ -322,15 +344,20 @@ def viable_duration(track, start_end):
 	dur = segs[start_end[1]].end - segs[start_end[0]].start
 	return dur	
 
+def title(track):
+	"""The track's title, or its filename when it wasn't loaded with one."""
+	fobj = getattr(track, 'fobj', None)
+	return fobj.title() if fobj is not None else track.filename
+
 def hard_transition(track1, track2):
 	"""Return playback instances for track1 all but first segment, track2 only seg1. """
 	# print("Track one has {} and {}.".format(dir(track1.fobj), dir(track1.analysis)))
-	log.info("Appending %s and %s", track1.fobj.title(), track2.fobj.title())
+	log.info("Appending %s and %s", title(track1), title(track2))
 	# print("These are by {} and {}".format(track1.fobj.title(), track2.fobj.title()))
 	segs1 = track1.analysis.segments
 	segs2 = track2.analysis.segments
 	start_end1 = [first_viable(track1), last_viable(track1)]
-	log.info("Track1 first: %r, last: %r", first_viable(track1), last_viable(track1))
+	log.info("Track1 first: %r, last: %r", start_end1[0], start_end1[1])
 	dur1 = viable_duration(track1, start_end1)
 	start2 = first_viable(track2) + 1
 	tr2_seg1_dur = segs2[start2].end - segs2[start2].start
@@ -342,7 +369,7 @@ def hard_transition(track1, track2):
 def hard_transition_r(track1, track2):
 	"""Return playback instances for track1 first segment, track2 all but final. """
 	# print("Track one has {} and {}.".format(dir(track1.fobj), dir(track1.analysis)))
-	log.info("Appending %s and %s", track1.fobj.title(), track2.fobj.title())
+	log.info("Appending %s and %s", title(track1), title(track2))
 	# print("These are by {} and {}".format(track1.fobj.title(), track2.fobj.title()))
 	segs1 = track1.analysis.segments
 	segs2 = track2.analysis.segments
@@ -356,27 +383,35 @@ def hard_transition_r(track1, track2):
 	return [pb1, pb2]
 
 def make_crossmatch(track1, track2, rate1, rate2, loc2, rows):
-	markers1 = upsample_list(getattr(track1.analysis, track1.resampled['rate']), rate1)
-	markers2 = upsample_list(getattr(track2.analysis, track2.resampled['rate']), rate2)
-
-	def to_tuples(l, i, n):
-		return [(t.start, t.duration) for t in l[i : i + n]]
+	markers1 = getattr(track1.analysis, track1.resampled['rate'])
+	markers2 = getattr(track2.analysis, track2.resampled['rate'])
 
 	start1 = rate1 * (track1.resampled['index'] + track1.resampled['cursor'])
 	start2 = loc2 + rate2 * track2.resampled['index']  # loc2 has already been multiplied by rate2
 
-	return Crossmatch((track1, track2), (to_tuples(markers1, start1, rows), to_tuples(markers2, start2, rows)))
+	# Upsample only the markers the crossmatch covers.
+	return Crossmatch((track1, track2), (upsample_window(markers1, rate1, start1, rows),
+										 upsample_window(markers2, rate2, start2, rows)))
 
 
 def make_transition(track1, track2, inter, transition):
+	"""A hard cut from track1 to track2; see aligned_transition for a beat-matched one."""
+	return hard_transition_r(track1, track2)
+
+
+def aligned_transition(track1, track2, inter, transition):
+	"""
+	Align the end of track1 with the best matching place in track2, and
+	return a Crossmatch between them and a Playback of track2 after it.
+	Falls back to a Crossfade when either track is too short to search.
+	"""
 	# the minimal transition is 2 markers
 	# the minimal inter is 0 sec
 	markers1 = getattr(track1.analysis, track1.resampled['rate'])
 	markers2 = getattr(track2.analysis, track2.resampled['rate'])
-	return hard_transition_r(track1, track2)
 
 	if len(markers1) < MIN_SEARCH or len(markers2) < MIN_SEARCH:
-		print "Making crossfade instead of transition!"
+		log.info("Making crossfade instead of transition!")
 		return make_crossfade(track1, track2, inter)
 
 	# though the minimal transition is 2 markers, the alignment is on at least 3 seconds
@@ -389,14 +424,14 @@ def make_transition(track1, track2, inter, transition):
 		return make_crossfade(track1, track2, inter)
 
 	if transition < MIN_ALIGN_DURATION:
-		print "Transition is less than minimum alignment duration!"
+		log.info("Transition is less than minimum alignment duration!")
 		duration, cursor = move_cursor(track2, transition, loc)
 		n = max(cursor - loc, MIN_MARKERS)
 
 	xm = make_crossmatch(track1, track2, rate1, rate2, loc, n)
 	# loc and n are both in terms of potentially upsampled data.
 	# Divide by rate here to get end_crossmatch in terms of the original data.
-	end_crossmatch = (loc + n) / rate2
+	end_crossmatch = (loc + n) // rate2
 
 	if markers2[-1].start < markers2[end_crossmatch].start + inter + transition:
 		inter = max(markers2[-1].start - transition, 0)
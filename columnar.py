@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# encoding: utf=8
+"""
+columnar.py
+
+Struct-of-arrays storage for Echonest analyses.
+
+An AudioAnalysis keeps every rate level (segments, tatums, beats, bars,
+sections) as a list of AudioQuantum objects. ColumnarAnalysis keeps each
+level as a QuantumArray: contiguous start/duration/confidence arrays, plus
+loudness columns and 12-column timbre and pitch matrices for segments.
+Indexing a QuantumArray creates a lightweight Quantum view on demand, so
+code written against AudioQuantum lists keeps working:
+
+    compact(track)              # or compact(track, packed=True)
+    track.analysis.segments[3].loudness_max
+    column(track.analysis.segments, 'start')    # numpy array, no views
+
+Packed arrays store times as int32 milliseconds and everything else as
+float16, roughly quartering the footprint again.
+"""
+import numpy as np
+
+RATES = ('sections', 'bars', 'beats', 'tatums', 'segments')
+COLUMNS = ('start', 'duration', 'confidence')
+SEGMENT_COLUMNS = COLUMNS + ('loudness_begin', 'loudness_max', 'time_loudness_max',
+                             'loudness_end', 'timbre', 'pitches')
+TIME_COLUMNS = ('start', 'duration', 'time_loudness_max')
+SCALARS = ('duration', 'loudness', 'tempo', 'key', 'mode', 'time_signature',
+           'end_of_fade_in', 'start_of_fade_out')
+ALIASES = {'pitch': 'pitches'}
+
+
+def column(quanta, name):
+    """
+    Return attribute name of every member of quanta as a numpy array, whether
+    quanta is a QuantumArray or a list of AudioQuantum objects.
+    """
+    if isinstance(quanta, QuantumArray):
+        return quanta.column(name)
+    return np.array([getattr(q, name) for q in quanta])
+
+
+class Quantum(object):
+    """A view of one row of a QuantumArray that reads like an AudioQuantum."""
+    __slots__ = ('quanta', 'index')
+
+    def __init__(self, quanta, index):
+        self.quanta = quanta
+        self.index = index
+
+    def __getattr__(self, name):
+        if name in Quantum.__slots__:
+            raise AttributeError(name)
+        return self.quanta.value(name, self.index)
+
+    @property
+    def end(self):
+        return self.start + self.duration
+
+    @property
+    def tatum(self):
+        """The tatum containing the start of this quantum, or None."""
+        return self.quanta.containing('tatums', self.start)
+
+    def __eq__(self, other):
+        return (isinstance(other, Quantum) and self.quanta.base is other.quanta.base and
+                self.quanta.rows[self.index] == other.quanta.rows[other.index])
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<Quantum %s %d: %.3f (%.3f)>" % (self.quanta.kind, self.index,
+                                                 self.start, self.duration)
+
+
+class QuantumArray(object):
+    """One rate level of an analysis, stored as parallel numpy columns."""
+    def __init__(self, columns, kind, analysis=None, base=None, rows=None):
+        self.columns = columns
+        self.kind = kind
+        self.analysis = analysis
+        # Views share their base, so Quantum equality survives slicing.
+        self.base = base if base is not None else self
+        self.rows = rows if rows is not None else np.arange(len(columns['start']))
+
+    @classmethod
+    def from_quanta(cls, quanta, kind, analysis=None):
+        names = SEGMENT_COLUMNS if kind == 'segments' else COLUMNS
+        columns = {}
+        for name in names:
+            values = [getattr(q, name, None) for q in quanta]
+            if name in ('timbre', 'pitches'):
+                columns[name] = np.array([v if v is not None else [np.nan] * 12 for v in values],
+                                         dtype=np.float32).reshape(-1, 12)
+            else:
+                columns[name] = np.array([v if v is not None else np.nan for v in values],
+                                         dtype=np.float64)
+        return cls(columns, kind, analysis)
+
+    def pack(self):
+        """Return a copy storing times as int32 milliseconds and the rest as float16."""
+        columns = {}
+        for name, values in self.columns.items():
+            if name in TIME_COLUMNS and values.dtype != np.int32:
+                columns[name] = np.round(values * 1000).astype(np.int32)
+            elif values.dtype != np.int32:
+                columns[name] = values.astype(np.float16)
+            else:
+                columns[name] = values
+        return QuantumArray(columns, self.kind, self.analysis)
+
+    @property
+    def nbytes(self):
+        return sum(v.nbytes for v in self.columns.values())
+
+    def column(self, name):
+        name = ALIASES.get(name, name)
+        if name == 'end':
+            return self.column('start') + self.column('duration')
+        values = self.columns[name]
+        if values.dtype == np.int32:
+            return values / 1000.0
+        if values.dtype == np.float16:
+            return values.astype(np.float32 if values.ndim == 2 else np.float64)
+        return values
+
+    def value(self, name, index):
+        name = ALIASES.get(name, name)
+        try:
+            values = self.columns[name]
+        except KeyError:
+            raise AttributeError(name)
+        v = values[index]
+        if values.ndim == 2:
+            return v.astype(np.float32)
+        if values.dtype == np.int32:
+            return v / 1000.0
+        return float(v)
+
+    def containing(self, kind, time):
+        """The member of another rate level of the same analysis containing time."""
+        if self.analysis is None:
+            return None
+        other = getattr(self.analysis, kind)
+        starts = other.column('start')
+        i = np.searchsorted(starts, time, side='right') - 1
+        if i < 0 or time >= starts[i] + other.column('duration')[i]:
+            return None
+        return other[int(i)]
+
+    def __len__(self):
+        return len(self.columns['start'])
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield Quantum(self, i)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, long, np.integer)):
+            n = len(self)
+            if index < 0:
+                index += n
+            if not 0 <= index < n:
+                raise IndexError(index)
+            return Quantum(self, index)
+        columns = dict((name, values[index]) for name, values in self.columns.items())
+        return QuantumArray(columns, self.kind, self.analysis, self.base, self.rows[index])
+
+    def index(self, quantum):
+        if isinstance(quantum, Quantum) and quantum.quanta.base is self.base:
+            found = np.flatnonzero(self.rows == quantum.quanta.rows[quantum.index])
+            if len(found):
+                return int(found[0])
+        raise ValueError("quantum not in %s" % self.kind)
+
+    def __repr__(self):
+        return "<QuantumArray %s (%d)>" % (self.kind, len(self))
+
+
+class ColumnarAnalysis(object):
+    """
+    An analysis whose rate levels are QuantumArrays. A level may also be given
+    as a function returning its QuantumArray, which is called on first access.
+    """
+    def __init__(self, levels, scalars):
+        self.levels = {}
+        for kind, quanta in levels.items():
+            if isinstance(quanta, QuantumArray):
+                quanta.analysis = self
+            self.levels[kind] = quanta
+        for name, value in scalars.items():
+            setattr(self, name, value)
+
+    @classmethod
+    def from_analysis(cls, analysis, packed=False):
+        levels = {}
+        for kind in RATES:
+            quanta = QuantumArray.from_quanta(getattr(analysis, kind, []), kind)
+            levels[kind] = quanta.pack() if packed else quanta
+        scalars = dict((name, getattr(analysis, name, None)) for name in SCALARS)
+        return cls(levels, scalars)
+
+    def level(self, kind):
+        quanta = self.levels[kind]
+        if not isinstance(quanta, QuantumArray):
+            quanta = self.levels[kind] = quanta()
+            quanta.analysis = self
+        return quanta
+
+    def __getattr__(self, name):
+        if name in self.__dict__.get('levels', ()):
+            return self.level(name)
+        raise AttributeError(name)
+
+    def scalars(self):
+        return dict((name, getattr(self, name, None)) for name in SCALARS)
+
+    def pack(self):
+        levels = dict((kind, self.level(kind).pack()) for kind in self.levels)
+        return ColumnarAnalysis(levels, self.scalars())
+
+    @property
+    def nbytes(self):
+        """Bytes held by the levels loaded so far."""
+        return sum(quanta.nbytes for quanta in self.levels.values()
+                   if isinstance(quanta, QuantumArray))
+
+
+def compact(track, packed=False):
+    """Replace track.analysis with its columnar equivalent and return track."""
+    if not isinstance(track.analysis, ColumnarAnalysis):
+        track.analysis = ColumnarAnalysis.from_analysis(track.analysis, packed)
+    elif packed:
+        track.analysis = track.analysis.pack()
+    return track
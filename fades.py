@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# encoding: utf=8
+"""
+fades.py
+
+Fade and crossfade kernels written with whole-array NumPy operations, in
+place of the cAction extension.
+
+A fade's gain curve is computed once per (length, mode) and kept in a small
+cache, so the fades in a mix, which mostly share a few lengths, reuse their
+tables. Modes:
+
+    linear       gain rises in a straight line
+    equal_power  sine/cosine gains; the crossfade keeps constant power
+    s_curve      smoothstep: slow at both ends, fast in the middle
+    log          rises fast, then levels off, like a logarithmic fader
+
+A fade out uses its mode's curve backwards. The kernels write into out,
+which may be the input itself when that is a float32 array. They work on
+(n,) or (n, channels) blocks. A long fade can be applied one block at a time,
+as it streams, by giving each block's offset into the fade and the fade's
+total length:
+
+    for offset in xrange(0, total, block):
+        fades.fade_out(data[offset:offset + block], 'log', offset=offset, total=total)
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+MODES = {
+    'linear': lambda t: t,
+    'equal_power': lambda t: np.sin(t * (np.pi / 2)),
+    's_curve': lambda t: t * t * (3 - 2 * t),
+    'log': lambda t: np.log10(1 + 9 * t),
+}
+# Curves kept, and frames crossfaded per step so the scratch stays in cache.
+CURVES = 64
+BLOCK_FRAMES = 16384
+
+_curves = OrderedDict()
+_curves_lock = threading.Lock()
+
+
+def curve(length, mode='linear'):
+    """
+    The read-only float32 gains of a fade in of length frames: length + 1
+    values, for times 0, 1/length, ... 1. Frame i of a fade in is scaled by
+    curve[i], and of a fade out by curve[length - i].
+    """
+    key = (length, mode)
+    with _curves_lock:
+        gains = _curves.pop(key, None)
+        if gains is not None:
+            _curves[key] = gains
+            return gains
+    if mode not in MODES:
+        raise ValueError("Unknown fade mode %r; use one of %s" %
+                         (mode, ', '.join(sorted(MODES))))
+    t = np.arange(length + 1, dtype=np.float64) / max(length, 1)
+    gains = MODES[mode](t).astype(np.float32)
+    gains.flags.writeable = False
+    with _curves_lock:
+        _curves[key] = gains
+        while len(_curves) > CURVES:
+            _curves.popitem(last=False)
+    return gains
+
+
+def _gains(n, mode, offset, total, reverse, ndim):
+    """The gains for n frames starting offset frames into a fade, shaped to
+    scale a block with ndim dimensions."""
+    if total is None:
+        total = offset + n
+    if offset < 0 or offset + n > total:
+        raise ValueError("Frames %d to %d are outside a fade of %d" %
+                         (offset, offset + n, total))
+    gains = curve(total, mode)
+    if reverse:
+        gains = gains[total - offset - n + 1:total - offset + 1][::-1]
+    else:
+        gains = gains[offset:offset + n]
+    return gains if ndim == 1 else gains[:, np.newaxis]
+
+
+def _fade(data, mode, gain, offset, total, out, reverse):
+    g = _gains(len(data), mode, offset, total, reverse, data.ndim)
+    if gain != 1:
+        g = g * np.float32(gain)
+    if out is None:
+        out = data
+    return np.multiply(data, g, out=out)
+
+
+def fade_in(data, mode='linear', gain=1.0, offset=0, total=None, out=None):
+    """Scales data by a fade in, and by gain, into out (data itself unless
+    given). Returns out."""
+    return _fade(data, mode, gain, offset, total, out, False)
+
+
+def fade_out(data, mode='linear', gain=1.0, offset=0, total=None, out=None):
+    """Scales data by a fade out, and by gain, into out (data itself unless
+    given). Returns out."""
+    return _fade(data, mode, gain, offset, total, out, True)
+
+
+def _sum(data1, data2, gains1, gains2, out):
+    """out = data1 * gains1(i, j) + data2 * gains2(i, j), BLOCK_FRAMES frames
+    [i, j) at a time, so the only scratch is one block."""
+    n = min(len(data1), len(data2))
+    if out is None:
+        out = np.empty((n,) + data1.shape[1:], dtype=np.float32)
+    scratch = np.empty((min(n, BLOCK_FRAMES),) + data1.shape[1:], dtype=np.float32)
+    for i in xrange(0, n, BLOCK_FRAMES):
+        j = min(i + BLOCK_FRAMES, n)
+        o, s = out[i:j], scratch[:j - i]
+        np.multiply(data1[i:j], gains1(i, j), out=o)
+        np.multiply(data2[i:j], gains2(i, j), out=s)
+        o += s
+    return out
+
+
+def crossfade(data1, data2, mode='linear', offset=0, total=None, out=None, gains=(1.0, 1.0)):
+    """
+    Fades data1 out and data2 in over the frames they share, scaling each by
+    its gain in gains, summing them into out: a new float32 array unless
+    given. Returns out.
+    """
+    if total is None:
+        total = offset + min(len(data1), len(data2))
+
+    def fader(reverse, gain, ndim):
+        def gains_for(i, j):
+            g = _gains(j - i, mode, offset + i, total, reverse, ndim)
+            return g * np.float32(gain) if gain != 1 else g
+        return gains_for
+    return _sum(data1, data2, fader(True, gains[0], data1.ndim),
+                fader(False, gains[1], data2.ndim), out)
+
+
+def mix(data1, data2, gains=(1.0, 1.0), out=None):
+    """Sums data1 and data2, each scaled by its gain in gains, over the frames
+    they share, into out: a new float32 array unless given. Returns out."""
+    g1, g2 = np.float32(gains[0]), np.float32(gains[1])
+    return _sum(data1, data2, lambda i, j: g1, lambda i, j: g2, out)
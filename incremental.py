@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# encoding: utf=8
+"""
+incremental.py
+
+Re-renders a mix after an edit without redoing the actions that didn't
+change.
+
+Beside the encoded output, render() keeps the mix as raw 16-bit stereo PCM
+(<output>.pcm) and a manifest (<output>.render.json). The manifest records,
+for every action, a hash of its parameters and source files (from
+render_cache.action_key), and where its frames sit in the PCM, with a
+checksum. On the next run only the actions with a new hash are rendered:
+
+- If every action still has the same length, the new frames are written
+  over the old ones in the PCM file.
+- Otherwise the PCM is rebuilt, copying unchanged actions' frames from the
+  old file.
+
+The output is re-encoded from the PCM only if something changed.
+
+    output, stats = incremental.render(actions, 'mix.mp3')
+    # ... edit one Crossfade ...
+    output, stats = incremental.render(actions, 'mix.mp3')   # stats['rendered'] == 1
+"""
+from __future__ import print_function
+import os
+import json
+import zlib
+import hashlib
+
+import render_trace
+from action import PCMWriter, pcm_bytes, release
+from render_cache import action_key
+
+MANIFEST_VERSION = 1
+FRAME_BYTES = 4
+CHUNK_BYTES = 2 ** 20 * FRAME_BYTES
+
+
+def paths(filename):
+    """(pcm path, manifest path) kept for output filename."""
+    return filename + '.pcm', filename + '.render.json'
+
+
+def action_digest(a):
+    """Hash of everything a's output depends on, or None if it can't be known."""
+    key = action_key(a)
+    if key is None:
+        return None
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+def checksum(frames):
+    return zlib.crc32(frames) & 0xffffffff
+
+
+def load_manifest(filename):
+    """The manifest of the last render to filename, if its PCM is intact."""
+    pcm_path, manifest_path = paths(filename)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION or not os.path.exists(pcm_path) or \
+            os.path.getsize(pcm_path) != manifest.get('bytes'):
+        return None
+    return manifest
+
+
+def _render(a, cache):
+    piece = cache.render(a) if cache is not None else render_trace.render(a)
+    frames = pcm_bytes(piece)
+    release(piece)
+    return frames
+
+
+def _read(f, entry):
+    f.seek(entry['offset'] * FRAME_BYTES)
+    frames = f.read(entry['frames'] * FRAME_BYTES)
+    if len(frames) == entry['frames'] * FRAME_BYTES and checksum(frames) == entry['crc']:
+        return frames
+
+
+def encode(pcm_path, filename, bitRate=128, verbose=True):
+    """Encodes a raw PCM file to filename, streaming it through the encoder."""
+    writer = PCMWriter(filename, bitRate=bitRate, verbose=verbose)
+    try:
+        with open(pcm_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_BYTES), b''):
+                writer.write_frames(chunk)
+    except:
+        writer.kill()
+        raise
+    return writer.close()
+
+
+def render(actions, filename, verbose=True, bitRate=128, cache=None):
+    """
+    Render actions to filename, reusing what the previous render to filename
+    can supply. Returns (filename, stats), where stats counts the actions
+    rendered and reused and says whether the output was encoded.
+    """
+    actions = list(actions)
+    pcm_path, manifest_path = paths(filename)
+    keys = [action_digest(a) for a in actions]
+    old = load_manifest(filename)
+    previous = old['actions'] if old else []
+    stats = {'rendered': 0, 'reused': 0, 'encoded': False}
+
+    by_key = {}
+    for entry in previous:
+        if entry['key'] is not None:
+            by_key.setdefault(entry['key'], entry)
+
+    # With the same actions in the same places, the changed ones can be
+    # written over the old spans if they keep their lengths. Only those are
+    # held in memory; anything else is rendered as the new file is written.
+    fresh = {}
+    in_place = bool(old) and len(actions) == len(previous)
+    if in_place:
+        for i, (a, key) in enumerate(zip(actions, keys)):
+            if key is not None and key == previous[i]['key']:
+                continue
+            if key is not None and key in by_key:
+                # Moved from elsewhere in the mix: copy it instead.
+                in_place = False
+                break
+            fresh[i] = _render(a, cache)
+            if len(fresh[i]) != previous[i]['frames'] * FRAME_BYTES:
+                in_place = False
+                break
+    if in_place:
+        # Same layout: write the new spans over the old ones. Until the new
+        # manifest is saved, the old one must not vouch for those spans.
+        entries = [dict(entry) for entry in previous]
+        if fresh:
+            pending = [dict(entry, key=None) if i in fresh else entry
+                       for i, entry in enumerate(previous)]
+            _save_manifest(manifest_path, dict(old, actions=pending, encoded=False))
+        with open(pcm_path, 'r+b') as f:
+            for i, data in sorted(fresh.items()):
+                f.seek(entries[i]['offset'] * FRAME_BYTES)
+                f.write(data)
+                entries[i].update(key=keys[i], crc=checksum(data))
+        stats['rendered'] = len(fresh)
+        stats['reused'] = len(actions) - len(fresh)
+    else:
+        entries = _rebuild(actions, keys, fresh, by_key, pcm_path, manifest_path, cache, stats)
+
+    size = sum(entry['frames'] for entry in entries) * FRAME_BYTES
+    manifest = {'version': MANIFEST_VERSION, 'bitRate': bitRate, 'bytes': size,
+                'actions': entries}
+    changed = stats['rendered'] or keys != [entry['key'] for entry in previous]
+    if changed or not old or old.get('bitRate') != bitRate or not old.get('encoded') or \
+            not os.path.exists(filename):
+        # Forget the old encode until the new one has finished.
+        _save_manifest(manifest_path, dict(manifest, encoded=False))
+        encode(pcm_path, filename, bitRate, verbose)
+        stats['encoded'] = True
+    _save_manifest(manifest_path, dict(manifest, encoded=True))
+    return filename, stats
+
+
+def _rebuild(actions, keys, fresh, by_key, pcm_path, manifest_path, cache, stats):
+    """Write a new PCM file, copying reused actions from the old one and
+    rendering the rest (unless already in fresh) as it goes, and return the
+    manifest entries."""
+    tmp = '%s.%d.tmp' % (pcm_path, os.getpid())
+    old = open(pcm_path, 'rb') if by_key else None
+    entries = []
+    offset = 0
+    try:
+        with open(tmp, 'wb') as out:
+            for i, (a, key) in enumerate(zip(actions, keys)):
+                data = fresh.pop(i, None)
+                rendered = data is not None
+                if data is None and key in by_key:
+                    data = _read(old, by_key[key])
+                if data is None:
+                    # The old frames don't match their checksum.
+                    data = _render(a, cache)
+                    rendered = True
+                stats['rendered' if rendered else 'reused'] += 1
+                out.write(data)
+                n = len(data) // FRAME_BYTES
+                entries.append({'key': key, 'offset': offset, 'frames': n, 'crc': checksum(data)})
+                offset += n
+    finally:
+        if old is not None:
+            old.close()
+    # The old manifest describes the old file; drop it before replacing that.
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    os.rename(tmp, pcm_path)
+    return entries
+
+
+def _save_manifest(path, manifest):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.rename(tmp, path)
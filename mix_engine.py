@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# encoding: utf=8
+"""
+mix_engine.py
+
+Renders an ordered list of tracks into one continuous mix, built on the
+capsule_support building blocks.
+
+Each step runs as its own pipeline stage on a thread, connected by small
+bounded queues:
+
+    load -> resample features -> plan (align, transitions) -> render -> encode
+
+While one pair of tracks is being planned the next track is already
+resampling, and earlier actions are rendering and encoding. The bounded
+queues cap how many tracks and rendered pieces are in memory at once.
+
+The plan stage aligns each pair with capsule_support.aligned_transition,
+joining them with a beat-matched Crossmatch. With align=False it joins them
+with make_transition's hard cuts instead.
+
+    import mix_engine
+    mix_engine.mix(['audio/a.mp3.analysis.npz', 'audio/b.mp3.analysis.npz'], 'mix.mp3')
+"""
+from __future__ import print_function
+import logging
+import threading
+import time
+from Queue import Queue, Empty, Full
+
+import render_trace
+from action import PCMWriter, release
+from capsule_support import (equalize_tracks, resample_features, timbre_whiten, is_valid,
+                             initialize, aligned_transition, make_transition, terminate,
+                             FADE_OUT)
+from mix_tracks_utils import TrackCache
+
+log = logging.getLogger(__name__)
+
+INTER = 8.0
+TRANSITION = 4.0
+QUEUE_SIZE = 2
+
+_DONE = object()
+
+
+class Stopped(Exception):
+    """Raised inside a stage when another stage has failed."""
+
+
+class MixEngine(object):
+    """
+    Pipelined mix of filenames (anything lazarus loads) into output. Each
+    stage records how long it spent working, in seconds, in busy.
+    """
+    def __init__(self, filenames, output, inter=INTER, transition=TRANSITION, rate='beats',
+                 cache=None, tracks=None, queue_size=QUEUE_SIZE, verbose=False, align=True):
+        self.filenames = list(filenames)
+        self.output = output
+        self.inter = inter
+        self.transition = transition
+        self.rate = rate
+        self.cache = cache
+        self.tracks = tracks or TrackCache(size=queue_size + 2)
+        self.queue_size = queue_size
+        self.verbose = verbose
+        self.transition_for = aligned_transition if align else make_transition
+        self.busy = {}
+        self.error = None
+        self.stop = threading.Event()
+
+    def put(self, q, item):
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+        raise Stopped()
+
+    def get(self, q):
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except Empty:
+                pass
+        raise Stopped()
+
+    def timed(self, name, func, *args):
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.busy[name] = self.busy.get(name, 0) + time.time() - start
+
+    # Stages. Each one reads its inbox until _DONE and passes _DONE on.
+
+    def load(self, outbox):
+        for filename in self.filenames:
+            self.put(outbox, self.timed('load', self.tracks.get, filename))
+
+    def prepare(self, inbox, outbox):
+        for track in iter(lambda: self.get(inbox), _DONE):
+            self.timed('resample', self.resample, track)
+            if is_valid(track, self.transition):
+                self.put(outbox, track)
+            else:
+                log.warning("Skipping %s: too short for the transition", track.filename)
+
+    def resample(self, track):
+        equalize_tracks([track])
+        track.resampled = resample_features(track, rate=self.rate)
+        track.resampled['matrix'] = timbre_whiten(track.resampled['matrix'])
+
+    def plan(self, inbox, outbox):
+        previous = None
+        for track in iter(lambda: self.get(inbox), _DONE):
+            if previous is None:
+                actions = self.timed('plan', initialize, track, self.inter, self.transition)
+            else:
+                actions = self.timed('plan', self.transition_for, previous, track,
+                                     self.inter, self.transition)
+            for a in actions:
+                self.put(outbox, a)
+            previous = track
+        if previous is not None:
+            for a in terminate(previous, FADE_OUT):
+                self.put(outbox, a)
+
+    def render(self, inbox, outbox):
+        for a in iter(lambda: self.get(inbox), _DONE):
+            if self.verbose:
+                print(a)
+            if self.cache is not None:
+                piece = self.timed('render', self.cache.render, a)
+            else:
+                piece = self.timed('render', render_trace.render, a)
+            self.put(outbox, piece)
+
+    def encode(self, inbox):
+        writer = PCMWriter(self.output, verbose=self.verbose)
+        try:
+            for piece in iter(lambda: self.get(inbox), _DONE):
+                self.timed('encode', writer.write, piece)
+                release(piece)
+        except:
+            writer.kill()
+            raise
+        writer.close()
+
+    def run_stage(self, stage, inbox, outbox):
+        try:
+            if inbox is None:
+                stage(outbox)
+            elif outbox is None:
+                stage(inbox)
+            else:
+                stage(inbox, outbox)
+            if outbox is not None:
+                self.put(outbox, _DONE)
+        except Stopped:
+            pass
+        except Exception as e:
+            log.exception("%s stage failed", stage.__name__)
+            self.error = self.error or e
+            self.stop.set()
+
+    def run(self):
+        """Run every stage to completion and return the output filename."""
+        stages = [self.load, self.prepare, self.plan, self.render, self.encode]
+        queues = [None] + [Queue(maxsize=self.queue_size) for s in stages[1:]] + [None]
+        threads = [threading.Thread(target=self.run_stage, args=(stage, queues[i], queues[i + 1]),
+                                    name=stage.__name__)
+                   for i, stage in enumerate(stages)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if self.error is not None:
+            raise self.error
+        return self.output
+
+
+def mix(filenames, output, inter=INTER, transition=TRANSITION, **kwargs):
+    """Mix filenames, in order, into output and return its filename."""
+    return MixEngine(filenames, output, inter, transition, **kwargs).run()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# encoding: utf=8
+"""
+mix_plan.py
+
+A serializable form of an action list. A plan refers to tracks by the md5
+of their audio file rather than holding them, so it can be computed on one
+machine, rendered on another, and cached by its own hash:
+
+    {"format": "remix-plan", "version": 1,
+     "tracks": {"<md5>": {"path": "audio/one.mp3.analysis.npz", "gain": 0.9}, ...},
+     "actions": [{"type": "Fadein", "track": "<md5>", "start": 9.0, "duration": 1.0,
+                  "mode": "s_curve"},
+                 {"type": "Playback", "track": "<md5>", "start": 10.0, "duration": 20.0},
+                 {"type": "Crossfade", "tracks": ["<md5>", "<md5>"], "starts": [30.0, 0.0],
+                  "duration": 4.0, "mode": "linear"},
+                 {"type": "Crossmatch", "tracks": [...], "lists": [[[s, d], ...], [[s, d], ...]]},
+                 ...]}
+
+optimize() simplifies a plan before rendering. It drops actions that
+produce no audio and merges Playbacks of the same track that follow on
+from each other, so the track is sliced, scaled and copied once. It also
+folds gain application: gain is stored once per track and dropped when it
+is 1, and each action applies it in the same pass as its copy, fade,
+crossfade or blend, so no audio is scaled twice.
+
+    plan = mix_plan.optimize(mix_plan.from_actions(actions))
+    mix_plan.save(plan, 'mix.plan.json.gz')
+    action.render(mix_plan.to_actions(mix_plan.load('mix.plan.json.gz')), 'mix.mp3')
+"""
+import os
+import re
+import gzip
+import json
+import hashlib
+import threading
+
+import action
+import analysis_store
+from mix_tracks_utils import file_digest, lazarus
+from render_cache import track_identity
+
+FORMAT = 'remix-plan'
+FORMAT_VERSION = 1
+# Playbacks closer than half a sample at 44.1kHz are contiguous.
+EPSILON = 0.5 / 44100
+# Track keys of this form are the md5 of the track's audio, and are checked.
+DIGEST = re.compile('^[0-9a-f]{32}$')
+
+_digests = {}
+_digests_lock = threading.Lock()
+
+
+def track_digest(track):
+    """The md5 of track's audio file, remembered per (file, size, mtime)."""
+    identity = track_identity(track)
+    if identity is None:
+        raise ValueError("%r has no file to hash" % track)
+    with _digests_lock:
+        digest = _digests.get(identity)
+    if digest is None:
+        digest = file_digest(identity[0])
+        with _digests_lock:
+            _digests[identity] = digest
+    return digest
+
+
+def _saved_path(track):
+    """The file lazarus should load track from: its analysis store or pickle."""
+    for path in (analysis_store.store_path(track.filename),
+                 track.filename + analysis_store.PICKLE_EXTENSION):
+        if os.path.exists(path):
+            return path
+    return track.filename
+
+
+def _describe(a, key):
+    """The plan entry for one action, naming tracks with key(track)."""
+    if isinstance(a, action.Blend):
+        entry = {'type': type(a).__name__, 'tracks': [key(a.t1), key(a.t2)],
+                 'lists': [[list(x) for x in a.l1], [list(x) for x in a.l2]]}
+        if isinstance(a, action.Mix):
+            entry['mode'] = a.mode
+        return entry
+    if isinstance(a, action.Jump):
+        return {'type': 'Jump', 'track': key(a.track), 'source': a.source,
+                'target': a.target, 'duration': a.duration}
+    if isinstance(a, action.Crossfade):
+        return {'type': 'Crossfade', 'tracks': [key(a.t1.track), key(a.t2.track)],
+                'starts': [a.t1.start, a.t2.start], 'duration': a.duration, 'mode': a.mode}
+    for cls in (action.Fadein, action.Fadeout, action.Playback):
+        if isinstance(a, cls):
+            entry = {'type': cls.__name__, 'track': key(a.track), 'start': a.start,
+                     'duration': a.duration}
+            if cls is not action.Playback:
+                entry['mode'] = a.mode
+            return entry
+    raise ValueError("Can't describe %r in a plan" % a)
+
+
+def from_actions(actions, key=track_digest):
+    """Return the plan for a list of actions."""
+    tracks = {}
+
+    def register(track):
+        k = key(track)
+        if k not in tracks:
+            tracks[k] = {'path': _saved_path(track), 'gain': getattr(track, 'gain', None)}
+        return k
+    return {'format': FORMAT, 'version': FORMAT_VERSION, 'tracks': tracks,
+            'actions': [_describe(a, register) for a in actions]}
+
+
+ACTIONS = {
+    'Playback': lambda a, t: action.Playback(t[a['track']], a['start'], a['duration']),
+    'Fadein': lambda a, t: action.Fadein(t[a['track']], a['start'], a['duration'],
+                                         a.get('mode', 'linear')),
+    'Fadeout': lambda a, t: action.Fadeout(t[a['track']], a['start'], a['duration'],
+                                           a.get('mode', 'linear')),
+    'Crossfade': lambda a, t: action.Crossfade([t[k] for k in a['tracks']], a['starts'],
+                                               a['duration'], a.get('mode', 'linear')),
+    'Jump': lambda a, t: action.Jump(t[a['track']], a['source'], a['target'], a['duration']),
+    'Crossmatch': lambda a, t: action.Crossmatch([t[k] for k in a['tracks']],
+                                                 [[tuple(x) for x in l] for l in a['lists']]),
+    'Blend': lambda a, t: action.Blend([t[k] for k in a['tracks']],
+                                       [[tuple(x) for x in l] for l in a['lists']]),
+    'Mix': lambda a, t: action.Mix([t[k] for k in a['tracks']],
+                                   [[tuple(x) for x in l] for l in a['lists']],
+                                   a.get('mode', 'linear')),
+}
+
+
+class PlanTrack(object):
+    """
+    A loaded track with the gain one plan gives it. Everything else is read
+    from the track, which is never changed, so a track shared by several
+    plans (from a TrackCache, say) can have a different gain in each.
+    """
+    def __init__(self, track, gain=None):
+        self.track = track
+        if gain is not None:
+            self.gain = gain
+
+    def __getattr__(self, name):
+        if name == 'gain' or name.startswith('__'):
+            # Only this plan's gain, never one set on the shared track.
+            raise AttributeError(name)
+        return getattr(self.__dict__['track'], name)
+
+    def __getitem__(self, index):
+        return self.track[index]
+
+    def __repr__(self):
+        return "<PlanTrack %r gain=%s>" % (self.track, getattr(self, 'gain', None))
+
+
+def load_tracks(plan, loader=lazarus):
+    """
+    Return {key: PlanTrack} for a plan's tracks, loaded with loader(path).
+    Raises ValueError if a track keyed by an md5 no longer has that md5, so
+    a plan never renders audio that has changed since it was made.
+    """
+    tracks = {}
+    for k, spec in plan['tracks'].items():
+        if not isinstance(spec, dict):
+            spec = {'path': spec}
+        track = loader(spec['path'])
+        if DIGEST.match(k) and track_digest(track) != k:
+            raise ValueError("Track %s: the audio of %s has changed since the plan was made" %
+                             (k, spec['path']))
+        tracks[k] = PlanTrack(track, spec.get('gain'))
+    return tracks
+
+
+def to_actions(plan, tracks=None, loader=lazarus):
+    """Return the actions a plan describes, on tracks ({key: track}, loaded
+    with loader if not given)."""
+    if plan.get('version', 0) > FORMAT_VERSION:
+        raise ValueError("Plan format version %s is newer than %d" %
+                         (plan.get('version'), FORMAT_VERSION))
+    if tracks is None:
+        tracks = load_tracks(plan, loader)
+    actions = []
+    for i, a in enumerate(plan['actions']):
+        try:
+            actions.append(ACTIONS[a['type']](a, tracks))
+        except KeyError as e:
+            raise ValueError("Action %d: unknown type or missing field %s" % (i, e))
+    return actions
+
+
+def _length(a):
+    if 'lists' in a:
+        return min(len(l) for l in a['lists'])
+    return a['duration']
+
+
+def optimize(plan):
+    """Return a copy of plan without zero-length actions or gains of 1, and
+    with each run of contiguous Playbacks of one track merged into a single
+    Playback."""
+    actions = []
+    for a in plan['actions']:
+        if _length(a) <= 0:
+            continue
+        last = actions[-1] if actions else None
+        if (a['type'] == 'Playback' and last is not None and last['type'] == 'Playback' and
+                last['track'] == a['track'] and
+                abs(last['start'] + last['duration'] - a['start']) < EPSILON):
+            last['duration'] = a['start'] + a['duration'] - last['start']
+            continue
+        actions.append(dict(a))
+    tracks = {}
+    for k, spec in plan['tracks'].items():
+        if isinstance(spec, dict) and spec.get('gain') == 1:
+            spec = dict(spec, gain=None)
+        tracks[k] = spec
+    optimized = dict(plan)
+    optimized['tracks'] = tracks
+    optimized['actions'] = actions
+    return optimized
+
+
+def optimize_actions(actions):
+    """optimize() for a live action list; tracks stay the same objects."""
+    tracks = {}
+
+    def key(track):
+        tracks[id(track)] = track
+        return id(track)
+    plan = from_actions(actions, key)
+    return to_actions(optimize(plan), tracks)
+
+
+def dumps(plan):
+    """Canonical JSON for plan: the same plan always gives the same string."""
+    return json.dumps(plan, sort_keys=True, separators=(',', ':'))
+
+
+def plan_key(plan):
+    """Content hash of a plan, for caching its renders."""
+    return hashlib.sha1(dumps(plan).encode('utf-8')).hexdigest()
+
+
+def save(plan, path):
+    """Write plan to path, gzipped if path ends in .gz."""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wb') as f:
+        f.write(dumps(plan).encode('utf-8'))
+    return path
+
+
+def load(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        plan = json.loads(f.read().decode('utf-8'))
+    if plan.get('format') != FORMAT:
+        raise ValueError("%s is not a mix plan" % path)
+    return plan
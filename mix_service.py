@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# encoding: utf=8
+"""
+mix_service.py
+
+A local HTTP service that renders mix plans, for scripts that would
+otherwise each load tracks and call action.render themselves.
+
+    python mix_service.py [port]
+
+    POST /jobs                a JSON plan; 202 and the job, or 503 if the queue is full
+    GET  /jobs                every job's status
+    GET  /jobs/<id>           one job's status
+    GET  /jobs/<id>/events    progress as JSON lines, streamed until the job ends
+    GET  /jobs/<id>/result    the rendered file, once the job is done
+
+Plans are in the mix_plan format, optionally with an output name. Track
+keys can be any names, and a track can be given as just its path:
+
+    {"output": "mix.mp3",
+     "tracks": {"a": "audio/one.mp3.analysis.npz", "b": "audio/two.mp3.analysis.npz"},
+     "actions": [{"type": "Playback", "track": "a", "start": 10, "duration": 20},
+                 {"type": "Crossfade", "tracks": ["a", "b"], "starts": [30, 0], "duration": 4},
+                 {"type": "Playback", "track": "b", "start": 4, "duration": 30}]}
+
+Jobs wait in a bounded queue and are rendered by a pool of worker threads,
+streaming each piece into the encoder. Every job loads its tracks from one
+TrackCache, so a track used by several jobs is loaded once, even when they
+ask for it at the same time. Each job sees the shared track through a
+mix_plan.PlanTrack holding its own gain. Finished jobs and their files are
+kept for JOB_TTL seconds, and at most KEEP_JOBS of them; after that their
+ids are 404s. The service only listens on localhost.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import uuid
+import time
+import shutil
+import logging
+import threading
+from Queue import Queue, Full
+from collections import OrderedDict
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+import action
+import mix_plan
+from mix_tracks_utils import TrackCache
+
+log = logging.getLogger(__name__)
+
+usage = """
+Usage:
+    python mix_service.py [port]
+
+Example:
+    python mix_service.py 8765
+    curl -d @plan.json localhost:8765/jobs
+"""
+
+HOST = '127.0.0.1'
+PORT = 8765
+WORKERS = 2
+QUEUE_SIZE = 8
+TRACKS = 8
+OUTPUT_DIR = 'mixes'
+# Finished jobs, and their rendered files, are forgotten after JOB_TTL
+# seconds, or sooner when more than KEEP_JOBS have finished.
+JOB_TTL = 3600
+KEEP_JOBS = 100
+
+
+class Job(object):
+    """One plan being rendered. Every change of state is kept as an event."""
+    def __init__(self, plan, output):
+        self.id = uuid.uuid4().hex[:12]
+        self.plan = plan
+        self.output = output
+        self.state = 'queued'
+        self.done = 0
+        self.total = len(plan.get('actions', ()))
+        self.error = None
+        self.finished_at = None
+        self.events = []
+        self.changed = threading.Condition()
+        self.update()
+
+    def status(self):
+        return {'id': self.id, 'state': self.state, 'done': self.done, 'total': self.total,
+                'output': self.output, 'error': self.error}
+
+    def update(self, **fields):
+        with self.changed:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            if self.finished and self.finished_at is None:
+                self.finished_at = time.time()
+            event = self.status()
+            event['time'] = time.time()
+            self.events.append(event)
+            self.changed.notify_all()
+
+    @property
+    def finished(self):
+        return self.state in ('done', 'failed')
+
+    def wait_events(self, seen, timeout=15):
+        """Events after the first seen, waiting up to timeout for one."""
+        with self.changed:
+            if len(self.events) <= seen and not self.finished:
+                self.changed.wait(timeout)
+            return self.events[seen:]
+
+
+class MixService(object):
+    """Queues jobs and renders them on a pool of worker threads."""
+    def __init__(self, workers=WORKERS, queue_size=QUEUE_SIZE, tracks=TRACKS,
+                 output_dir=OUTPUT_DIR, cache=None, job_ttl=JOB_TTL, keep_jobs=KEEP_JOBS):
+        self.jobs = OrderedDict()
+        self.jobs_lock = threading.Lock()
+        self.job_ttl = job_ttl
+        self.keep_jobs = keep_jobs
+        self.queue = Queue(maxsize=queue_size)
+        self.tracks = TrackCache(size=tracks)
+        self.output_dir = output_dir
+        self.cache = cache
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        self.workers = [threading.Thread(target=self.work, name='mix-worker-%d' % i)
+                        for i in xrange(workers)]
+        for t in self.workers:
+            t.daemon = True
+            t.start()
+
+    def submit(self, plan):
+        """Queue plan and return its Job. Raises Queue.Full when the queue is."""
+        if not isinstance(plan, dict) or not plan.get('tracks') or not plan.get('actions'):
+            raise ValueError("A plan needs tracks and actions")
+        name = os.path.basename(plan.get('output') or '') or 'mix.mp3'
+        job = Job(plan, None)
+        job.output = os.path.join(self.output_dir, '%s-%s' % (job.id, name))
+        self.prune()
+        with self.jobs_lock:
+            self.queue.put_nowait(job)
+            self.jobs[job.id] = job
+        return job
+
+    def job(self, id):
+        """The job with this id, or None if there never was one or it has been forgotten."""
+        self.prune()
+        with self.jobs_lock:
+            return self.jobs.get(id)
+
+    def all_jobs(self):
+        self.prune()
+        with self.jobs_lock:
+            return list(self.jobs.values())
+
+    def prune(self):
+        """Forget finished jobs older than job_ttl, then the oldest finished
+        ones beyond keep_jobs, deleting their rendered files."""
+        now = time.time()
+        with self.jobs_lock:
+            finished = [job for job in self.jobs.values() if job.finished_at is not None]
+            finished.sort(key=lambda job: job.finished_at)
+            expired = [job for job in finished if now - job.finished_at > self.job_ttl]
+            rest = finished[len(expired):]
+            expired += rest[:max(len(rest) - self.keep_jobs, 0)]
+            for job in expired:
+                del self.jobs[job.id]
+        for job in expired:
+            try:
+                os.remove(job.output)
+            except OSError:
+                pass
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            try:
+                self.render(job)
+            except Exception as e:
+                log.exception("Job %s failed", job.id)
+                job.update(state='failed', error='%s: %s' % (type(e).__name__, e))
+
+    def render(self, job):
+        job.update(state='loading')
+        tracks = mix_plan.load_tracks(job.plan, self.tracks.get)
+        actions = mix_plan.to_actions(mix_plan.optimize(job.plan), tracks)
+        job.update(state='rendering', total=len(actions))
+
+        def progress():
+            for k, a in enumerate(actions):
+                yield a
+                # Resumed once a's piece has gone to the encoder.
+                job.update(done=k + 1)
+        action.render(progress(), job.output, verbose=False, stream=True, cache=self.cache)
+        job.update(state='done', done=len(actions))
+
+    def stop(self):
+        for t in self.workers:
+            self.queue.put(None)
+
+
+class Handler(BaseHTTPRequestHandler):
+    # Set on the server class by serve().
+    service = None
+
+    def send_json(self, code, body):
+        data = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def job(self, parts):
+        job = self.service.job(parts[1]) if len(parts) > 1 else None
+        if job is None:
+            self.send_json(404, {'error': 'no such job'})
+        return job
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            return self.send_json(404, {'error': 'not found'})
+        try:
+            plan = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            job = self.service.submit(plan)
+        except Full:
+            return self.send_json(503, {'error': 'queue full, try again later'})
+        except ValueError as e:
+            return self.send_json(400, {'error': str(e)})
+        self.send_json(202, job.status())
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts[0] != 'jobs':
+            return self.send_json(404, {'error': 'not found'})
+        if len(parts) == 1:
+            return self.send_json(200, [job.status() for job in self.service.all_jobs()])
+        job = self.job(parts)
+        if job is None:
+            return
+        if len(parts) == 2:
+            self.send_json(200, job.status())
+        elif parts[2] == 'events':
+            self.stream_events(job)
+        elif parts[2] == 'result':
+            self.send_result(job)
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def stream_events(self, job):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        seen = 0
+        while True:
+            events = job.wait_events(seen)
+            for event in events:
+                self.wfile.write(json.dumps(event) + '\n')
+            self.wfile.flush()
+            seen += len(events)
+            if job.finished and seen == len(job.events):
+                return
+
+    def send_result(self, job):
+        if job.state != 'done':
+            return self.send_json(409, job.status())
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(os.path.getsize(job.output)))
+        self.end_headers()
+        with open(job.output, 'rb') as f:
+            shutil.copyfileobj(f, self.wfile)
+
+    def log_message(self, format, *args):
+        log.info("%s %s", self.address_string(), format % args)
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(port=PORT, host=HOST, **kwargs):
+    """Run a MixService behind an HTTP server until interrupted."""
+    handler = type('BoundHandler', (Handler,), {'service': MixService(**kwargs)})
+    server = Server((host, port), handler)
+    log.info("Serving mixes on %s:%d", host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        handler.service.stop()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    try:
+        port = int(sys.argv[1]) if len(sys.argv) > 1 else PORT
+    except ValueError:
+        print(usage)
+        sys.exit(-1)
+    serve(port)
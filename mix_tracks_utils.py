@@ -16,19 +16,26 @@ By Mike iLL/mZoo.org, 2015-01-13.
 """
 from __future__ import print_function
 import echonest.remix.audio as audio
-from Queue import Queue
+from Queue import Queue, Empty, Full
+from collections import OrderedDict
 from action import Crossfade as cf
 from action import Playback as pb
 from action import Blend as bl
 from action import Fadeout as fade
 from action import render
 from action import make_stereo
+from action import find_ffmpeg
+from columnar import column
+from annotations import annotate
+import analysis_store
 
 import glob
 import sys, os
 import pickle
-import subprocess
-import echonest
+import json
+import hashlib
+import threading
+import numpy as np
 
 usage = """
 Usage: 
@@ -37,38 +44,138 @@ Usage:
 """
 
 LOUDNESS_THRESH = -8
-ffmpeg_command = None
-
-for command in ("avconv", "ffmpeg", "en-ffmpeg"):
-	try:
-		subprocess.Popen([command],stdout=subprocess.PIPE,stderr=subprocess.STDOUT).wait()
-		ffmpeg_command = command
-		break
-	except OSError:
-		# The command wasn't found. Move on to the next one.
-		pass
-if not ffmpeg_command:
-	raise RuntimeError("No avconv/ffmpeg found, cannot continue")
-echonest.remix.support.ffmpeg.FFMPEG = ffmpeg_command
+# Kept beside the store files of the first file ingested, unless given.
+MANIFEST = 'ingest_manifest.json'
+# Manifest entries changed between writes.
+MANIFEST_BATCH = 50
 
 def make_save_one(filename):
     """
     Get filename, make LocalAudioFile objects and save it. Return LAF.
     """
+    find_ffmpeg()
     audiofile = audio.LocalAudioFile(filename)
     'audiofile2 = audiofile'
     audiofile.save()
     return audiofile
     
-def make_save_all(files):
+def make_save_all(files, workers=4, manifest=None, progress=None):
     """
-    Get a list of files, make LocalAudioFile objects and save them.
+    Get a list of files, make LocalAudioFile objects and save them, several at a time.
+    Files already saved whose size and mtime, or content hash, match the manifest
+    are skipped. The manifest is MANIFEST beside the first file's store file
+    unless a path is given, and is not used when manifest is False. It is
+    written every MANIFEST_BATCH changes and at the end.
+    progress(done, total, file, status) is called as each file finishes.
+    Return a dict of file: 'saved', 'skipped' or the error that stopped it.
     """
+    if manifest is None and files:
+        manifest = manifest_path(files[0])
     q = file_queue(files)
+    entries = load_manifest(manifest) if manifest else {}
+    results = {}
+    lock = threading.Lock()
+    write_lock = threading.Lock()
+    changed = [0]
+    total = len(files)
 
-    while not q.empty():
-        file = q.get()
-        make_save_one(file)
+    def write_manifest():
+        with lock:
+            snapshot = dict(entries)
+            changed[0] = 0
+        with write_lock:
+            try:
+                save_manifest(manifest, snapshot)
+            except (IOError, OSError) as e:
+                print("Could not save the manifest {}: {}".format(manifest, e))
+
+    def report(file, status, entry=None):
+        with lock:
+            results[file] = status
+            if entry is not None:
+                entries[file] = entry
+                changed[0] += 1
+            done = len(results)
+            flush = manifest and changed[0] >= MANIFEST_BATCH
+        if flush:
+            write_manifest()
+        if progress:
+            progress(done, total, file, status)
+        else:
+            print("[{}/{}] {}: {}".format(done, total, file, status))
+
+    def ingest(file):
+        """Return the file's status and its new manifest entry, if any."""
+        st = os.stat(file)
+        entry = {'size': st.st_size, 'mtime': st.st_mtime}
+        with lock:
+            known = entries.get(file)
+        saved = os.path.exists(analysis_store.store_path(file))
+        if saved and known and (known['size'], known['mtime']) == (st.st_size, st.st_mtime):
+            return 'skipped', None
+        entry['md5'] = file_digest(file)
+        if saved and known and known.get('md5') == entry['md5']:
+            return 'skipped', entry
+        analysis_store.save_track(make_save_one(file))
+        return 'saved', entry
+
+    def work():
+        while True:
+            try:
+                file = q.get_nowait()
+            except Empty:
+                return
+            try:
+                status, entry = ingest(file)
+            except Exception as e:
+                status, entry = 'failed: {}'.format(e), None
+            report(file, status, entry)
+
+    threads = [threading.Thread(target=work) for i in range(min(workers, total))]
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        if manifest and changed[0]:
+            write_manifest()
+    return results
+
+def manifest_path(filename):
+    """
+    The default ingest manifest for filename: MANIFEST beside its store file.
+    """
+    return os.path.join(os.path.dirname(analysis_store.store_path(filename)), MANIFEST)
+
+def file_digest(filename, blocksize=2 ** 20):
+    """
+    Return the md5 hex digest of a file's contents.
+    """
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+def load_manifest(path):
+    """
+    Return the ingest manifest: a dict of file: {size, mtime, md5}.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def save_manifest(path, entries):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(entries, f, indent=1, sort_keys=True)
+    os.rename(tmp, path)
         
 def file_queue(files):
     """
@@ -89,24 +196,102 @@ def get_saved(directory = 'audio/', extension = 'en'):
         
 def lazarus(filename):
     """
-    Get pickled (*.en) filename (path) and return echonest analysis object
+    Get saved (*.en pickle or *.npz store) filename (path) and return echonest analysis object
     """
+    if filename.endswith(analysis_store.EXTENSION):
+        return analysis_store.load_track(filename)
+    find_ffmpeg()
     with open(filename) as f:
         return pickle.load(f)
         
-def raise_pairs_from_queue(q):
+class TrackCache(object):
     """
-    Get a queue, iterate and yield a list of two imported LocalAudioFiles
+    Bounded LRU of tracks loaded with lazarus, keyed by saved filename.
+    Threads asking for a track that is already loading wait for that load
+    instead of starting another.
     """
-    t1 = q.get()
-    q.task_done()
-    while not q.empty():
-        t2 = q.get()
-        q.task_done()
-        audiofile1 = lazarus(t1)
-        audiofile2 = lazarus(t2)
-        yield (audiofile1, audiofile2)
-        t1 = t2
+    def __init__(self, size=4, loader=None):
+        self.size = size
+        self.loader = loader or lazarus
+        self.tracks = OrderedDict()
+        self.loading = {}
+        self.loads = 0
+        self.lock = threading.Lock()
+
+    def get(self, filename):
+        with self.lock:
+            if filename in self.tracks:
+                track = self.tracks.pop(filename)
+                self.tracks[filename] = track
+                return track
+            event = self.loading.get(filename)
+            owner = event is None
+            if owner:
+                event = self.loading[filename] = threading.Event()
+        if not owner:
+            event.wait()
+            # Loaded meanwhile, unless it failed or was already evicted.
+            return self.get(filename)
+        try:
+            track = self.loader(filename)
+            with self.lock:
+                self.loads += 1
+                self.tracks[filename] = track
+                while len(self.tracks) > self.size:
+                    self.tracks.popitem(last=False)
+            return track
+        finally:
+            with self.lock:
+                del self.loading[filename]
+            event.set()
+
+def raise_pairs_from_queue(q, lookahead=1, cache=None):
+    """
+    Get a queue, iterate and yield a list of two imported LocalAudioFiles.
+    A background thread loads up to lookahead tracks ahead of the pair being
+    worked on, so each track is loaded once and loading overlaps the work.
+    """
+    cache = cache or TrackCache(size=lookahead + 2)
+    loaded = Queue(maxsize=lookahead)
+    stop = threading.Event()
+
+    def offer(item):
+        # Wait for room, unless the consumer has gone away.
+        while not stop.is_set():
+            try:
+                loaded.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def prefetch():
+        while not q.empty() and not stop.is_set():
+            filename = q.get()
+            q.task_done()
+            try:
+                offer((cache.get(filename), None))
+            except Exception as e:
+                offer((None, e))
+                return
+        offer((None, None))
+
+    def next_track():
+        track, error = loaded.get()
+        if error is not None:
+            raise error
+        return track
+
+    thread = threading.Thread(target=prefetch)
+    thread.daemon = True
+    thread.start()
+    try:
+        t1 = next_track()
+        t2 = next_track()
+        while t2 is not None:
+            yield (t1, t2)
+            t1, t2 = t2, next_track()
+    finally:
+        stop.set()
         
 def lazarus_queue(q):
 	"""
@@ -115,13 +300,15 @@ def lazarus_queue(q):
 	container = {}
 	while not q.empty():
 		track = q.get()	
-		filename = track.replace('.mp3.analysis.en', '')
+		filename = track.replace('.mp3.analysis.en', '').replace('.mp3.analysis.npz', '')
 		filename = filename.replace('audio/', '')
 		container[filename] = lazarus(track)
 	return container
         
 def resurrect():
-    files = get_saved()
+    # Prefer store files, falling back to pickles that haven't been converted.
+    files = get_saved(extension='npz')
+    files += [f for f in get_saved() if analysis_store.store_path(f) not in files]
     q = file_queue(files)
     return lazarus_queue(q)
         
@@ -138,9 +325,8 @@ def show_transitions():
 def trim_track(track, trim_start=0, trim_end=0):
 	"""Get echonest analysis object with count and return trimmed AudioQuantum list."""
 	music = audio.AudioQuantumList()
-	for k, v in enumerate(track.analysis.tatums):
-		if k >= trim_start and k < len(track.analysis.tatums) - trim_end:
-			music.append(v)
+	tatums = track.analysis.tatums
+	music.extend(tatums[trim_start:len(tatums) - trim_end])
 	return music
 	
 def tatum_count(track):
@@ -151,6 +337,7 @@ def analize(input_filename):
     """
     Get mp3 filename and return echonest analysis object
     """
+    find_ffmpeg()
     audiofile = audio.LocalAudioFile(input_filename)
     return audiofile.analysis
     
@@ -227,16 +414,12 @@ def compare(track, rate1="segments", rate2="tatums", direction="first", number=8
         print("No {}.".format(rate2))
         
 def last_viable(track):
-	for seg in reversed(track.analysis.segments):
-		if seg.loudness_max > -60:
-			#time of last audible piece of track
-			return seg.start + seg.duration
+	#time of last audible piece of track
+	return annotate(track.analysis).last_viable_time
 			
 def first_viable(track):
-	for seg in track.analysis.segments:
-		if seg.loudness_max > -60:
-			#time of first audible segment of track
-			return seg.start
+	#time of first audible segment of track
+	return annotate(track.analysis).first_viable_time
 			
 
 					
@@ -244,11 +427,9 @@ def end_trans(track, beats_to_mix = 0):
 	"""
 	Return tuples with times to be sent to Playback and Crossmix objects
 	"""
-	end_viable = last_viable(track)
-	try:
-		avg_duration = sum([b.duration for b in track.analysis.tatums[-16:]]) / 16
-	except IndexError:
-		avg_duration = sum([b.duration for b in track.analysis.segments[-8:]]) / 8
+	notes = annotate(track.analysis)
+	end_viable = notes.last_viable_time
+	avg_duration = notes.tatum_duration
 	#How much of the track are we returning - adjust for beats to mix?
 	start = track.analysis.duration - (10 + (avg_duration * beats_to_mix))
 	print(start)
@@ -262,9 +443,7 @@ def end_trans(track, beats_to_mix = 0):
 		playback_end = end_viable - 1 # try 10 - seconds?
 		final = 1
 		
-	try:
-		track.analysis.tatums[-1]
-	except IndexError:
+	if not len(track.analysis.tatums):
 		# if no tatums play through end of track
 		final_segments = {"subsequent_beat": track.analysis.segments[-final].start}
 		final_segments["playback_start"] = start
@@ -275,9 +454,10 @@ def end_trans(track, beats_to_mix = 0):
 		return final_segments
 
 	final_segments = {"subsequent_beat": track.analysis.tatums[-final].start}
-	while final_segments['subsequent_beat'] < playback_end:
+	if final_segments['subsequent_beat'] < playback_end and avg_duration > 0:
 		#get first "beat" following end of playback
-		final_segments['subsequent_beat'] += avg_duration
+		steps = np.ceil((playback_end - final_segments['subsequent_beat']) / avg_duration)
+		final_segments['subsequent_beat'] += steps * avg_duration
 
 	final_segments["playback_start"] = start
 	final_segments["playback_duration"] = playback_end - final_segments["playback_start"]
@@ -309,15 +489,7 @@ def lead_in(track):
 	"""
 	Return the time between start of track and first beat.
 	"""
-	avg_duration = sum([b.duration for b in track.analysis.beats[:8]]) / 8
-	try:
-		earliest_beat = track.analysis.beats[0].start
-	except IndexError:
-		earliest_beat = track.analysis.segments[0].start
-	while earliest_beat > 0:
-		earliest_beat -= avg_duration
-	offset = earliest_beat
-	return offset
+	return annotate(track.analysis).lead_in
 	
 def end_of_track(track1, track2, rate='beats'):
 	"""
@@ -325,9 +497,11 @@ def end_of_track(track1, track2, rate='beats'):
 	"""
 	if track1.analysis.duration < track2.analysis.duration:
 		track1, track2 = track2, track1
-	for k, v in enumerate(track1.analysis.beats):
-		if v.start + v.duration > track2.analysis.duration:
-			return (k, v)
+	beats = track1.analysis.beats
+	beyond = np.flatnonzero(column(beats, 'end') > track2.analysis.duration)
+	if len(beyond):
+		k = int(beyond[0])
+		return (k, beats[k])
 			
 def remove_channel(track, remove="left"):
 	"""
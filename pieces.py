@@ -28,6 +28,8 @@ By Mike iLL/mZoo.org, 2014-07-20.
 """
 from __future__ import print_function
 import echonest.remix.audio as audio
+import numpy as np
+from columnar import column
 import sys, os
 
 
@@ -96,7 +98,9 @@ def pre_tatum(track):
     """
     start = audio.AudioQuantumList()
     segs_in = 0
-    for segment in track.segments:
+    # Only segments starting before the first tatum can qualify.
+    early = np.flatnonzero(column(track.segments, 'start') < track.tatums[0].start)
+    for segment in (track.segments[i] for i in early):
         if (segment.loudness_max > -60) and (segment.tatum == None) \
         and (segment.start < track.tatums[0].start):
             start.append(segment)
@@ -149,9 +153,11 @@ def post_bar(track):
     """
     tatums_out=0
     lead_out = audio.AudioQuantumList() 
-    for tatum in track.tatums:
-        if tatum.end > track.bars[-1].end and tatum.start < track.segments[-1].start \
-        and not tatum == track.segments[-1].tatum:
+    tatums = track.tatums
+    outro = np.flatnonzero((column(tatums, 'end') > track.bars[-1].end) & 
+                           (column(tatums, 'start') < track.segments[-1].start))
+    for tatum in (tatums[i] for i in outro):
+        if not tatum == track.segments[-1].tatum:
             tatums_out += 1
             lead_out.append(tatum)
     try:
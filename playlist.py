@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# encoding: utf=8
+"""
+playlist.py
+
+Orders a crate of tracks so that consecutive tracks make good transitions.
+
+The cost of going from track i to track j combines how far the whitened
+timbre of i's outro is from j's intro (the evaluate_distance that align
+minimizes) with how far apart their tempos remain after the doubling align
+applies through get_adjustment. The matrix of all costs is computed in
+blocks of NumPy products and cached on disk. A nearest-neighbour tour,
+improved with 2-opt, then gives a low-cost order:
+
+    ordered = playlist.order_playlist(mix_tracks_utils.get_saved(extension='npz'))
+"""
+from __future__ import print_function
+import os
+import hashlib
+import logging
+
+import numpy as np
+
+from capsule_support import resample_features, timbre_whiten, adjustment_rates
+from columnar import column
+from mix_tracks_utils import lazarus
+
+log = logging.getLogger(__name__)
+
+ROWS = 16
+TEMPO_WEIGHT = 4.0
+BLOCK = 512
+
+
+def track_features(track, rate='beats', rows=ROWS):
+    """
+    Return (intro, outro, intro_duration, outro_duration) for track: its first
+    and last rows of whitened timbre, flattened, and the average marker
+    duration over each.
+    """
+    resampled = resample_features(track, rate=rate)
+    mat = timbre_whiten(resampled['matrix'])
+    if len(mat) < rows:
+        mat = np.pad(mat, ((0, rows - len(mat)), (0, 0)), mode='edge')
+    markers = getattr(track.analysis, rate)
+    durations = column(markers, 'duration')[resampled['index']:resampled['index'] + len(mat)]
+    if not len(durations):
+        durations = np.ones(1)
+    return (mat[:rows].ravel(), mat[-rows:].ravel(),
+            np.mean(durations[:rows]), np.mean(durations[-rows:]))
+
+
+def tempo_mismatch(outro_durations, intro_durations):
+    """
+    Octaves between marker durations left after get_adjustment's doubling,
+    for every (outro, intro) pair.
+    """
+    outro_durations = np.asarray(outro_durations, dtype=np.float64)[:, np.newaxis]
+    intro_durations = np.asarray(intro_durations, dtype=np.float64)
+    # The rates get_adjustment would pick, for every pair at once.
+    rate1, rate2 = adjustment_rates(outro_durations, intro_durations)
+    return np.abs(np.log2((outro_durations / rate1) / (intro_durations / rate2)))
+
+
+def cost_matrix(intros, outros, outro_durations, intro_durations,
+                tempo_weight=TEMPO_WEIGHT, block=BLOCK):
+    """
+    Return the matrix of transition costs from every outro to every intro, in
+    blocks of rows to bound memory. The diagonal is infinite.
+    """
+    intros = np.asarray(intros, dtype=np.float64)
+    outros = np.asarray(outros, dtype=np.float64)
+    n = len(outros)
+    cost = np.empty((n, len(intros)), dtype=np.float32)
+    intro_sq = (intros * intros).sum(1)
+    # Normalize by size so the distance doesn't depend on ROWS.
+    scale = 1.0 / np.sqrt(intros.shape[1])
+    for i in xrange(0, n, block):
+        a = outros[i:i + block]
+        d2 = (a * a).sum(1)[:, np.newaxis] + intro_sq - 2 * np.dot(a, intros.T)
+        cost[i:i + block] = np.sqrt(np.maximum(d2, 0)) * scale + \
+            tempo_weight * tempo_mismatch(outro_durations[i:i + block], intro_durations)
+    np.fill_diagonal(cost, np.inf)
+    return cost
+
+
+def _cache_key(filenames, rate, rows, tempo_weight):
+    h = hashlib.sha1()
+    for f in filenames:
+        st = os.stat(f)
+        h.update(('%s:%d:%d\n' % (f, st.st_size, int(st.st_mtime))).encode('utf-8'))
+    h.update(('%s:%d:%r' % (rate, rows, tempo_weight)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def transition_costs(filenames, rate='beats', rows=ROWS, tempo_weight=TEMPO_WEIGHT,
+                     cache_dir='audio/costs', loader=lazarus):
+    """
+    Return the transition cost matrix for saved tracks, loading it from
+    cache_dir when none of the files have changed.
+    """
+    path = None
+    if cache_dir:
+        path = os.path.join(cache_dir, _cache_key(filenames, rate, rows, tempo_weight) + '.npy')
+        if os.path.exists(path):
+            return np.load(path)
+    features = []
+    for k, f in enumerate(filenames):
+        features.append(track_features(loader(f), rate, rows))
+        log.info("Features %d/%d: %s", k + 1, len(filenames), f)
+    intros, outros, intro_durations, outro_durations = [np.array(x) for x in zip(*features)]
+    cost = cost_matrix(intros, outros, outro_durations, intro_durations, tempo_weight)
+    if path:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        np.save(path, cost)
+    return cost
+
+
+def path_cost(cost, order):
+    order = np.asarray(order)
+    return float(cost[order[:-1], order[1:]].sum())
+
+
+def nearest_neighbor(cost, start=0):
+    """Greedy path from start, always taking the cheapest unvisited track next."""
+    n = len(cost)
+    visited = np.zeros(n, dtype=bool)
+    order = [start]
+    visited[start] = True
+    for k in xrange(n - 1):
+        row = np.where(visited, np.inf, cost[order[-1]])
+        nxt = int(np.argmin(row))
+        order.append(nxt)
+        visited[nxt] = True
+    return order
+
+
+def two_opt(cost, order, passes=10):
+    """
+    Improve an open path by reversing sub-paths while that lowers its cost.
+    Costs are not symmetric, so a reversed sub-path is charged its backward
+    edges, kept as running sums to test every reversal from i at once.
+    """
+    order = np.array(order)
+    n = len(order)
+    for p in xrange(passes):
+        improved = False
+        for i in xrange(n - 2):
+            t = order
+            forward = np.concatenate(([0], np.cumsum(cost[t[:-1], t[1:]])))
+            backward = np.concatenate(([0], np.cumsum(cost[t[1:], t[:-1]])))
+            # Reverse t[i + 1:j + 1] for every j > i + 1.
+            j = np.arange(i + 2, n)
+            after = np.minimum(j + 1, n - 1)
+            tail = j + 1 < n
+            removed = cost[t[i], t[i + 1]] + np.where(tail, cost[t[j], t[after]], 0) + \
+                forward[j] - forward[i + 1]
+            added = cost[t[i], t[j]] + np.where(tail, cost[t[i + 1], t[after]], 0) + \
+                backward[j] - backward[i + 1]
+            gain = removed - added
+            best = int(np.argmax(gain))
+            if gain[best] > 1e-9:
+                jb = j[best]
+                order[i + 1:jb + 1] = order[i + 1:jb + 1][::-1].copy()
+                improved = True
+        if not improved:
+            break
+    return list(order)
+
+
+def order_playlist(filenames, start=0, passes=10, **kwargs):
+    """Return filenames in a low transition cost order, beginning with filenames[start]."""
+    if len(filenames) < 3:
+        return list(filenames)
+    cost = transition_costs(filenames, **kwargs)
+    order = two_opt(cost, nearest_neighbor(cost, start), passes)
+    log.info("Playlist cost %.3f", path_cost(cost, order))
+    return [filenames[k] for k in order]
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# encoding: utf=8
+"""
+render_cache.py
+
+Content-keyed LRU cache for the AudioData produced by rendering actions.
+
+make_transition and gimme_two produce the same Crossfade and Playback
+actions for the same pairs of tracks, so re-rendering a playlist after a
+small edit mostly repeats work. Pass a RenderCache to action.render:
+
+    cache = RenderCache(max_bytes=512 * 2**20, directory='render_cache/')
+    render(actions, 'mix.mp3', cache=cache)
+    print(cache.stats())
+"""
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from echonest.remix.audio import AudioData
+
+import render_trace
+
+
+def track_identity(track):
+    """
+    Return a key identifying the audio of track: its filename with the size
+    and mtime of the file, or None when the track isn't backed by a file.
+    """
+    return file_identity(getattr(track, 'filename', None))
+
+
+def file_identity(filename):
+    """(filename, size, mtime), or None if there is no such file."""
+    if not filename:
+        return None
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (filename, st.st_size, int(st.st_mtime))
+
+
+def _span(track, start, duration):
+    identity = track_identity(track)
+    if identity is None:
+        return None
+    return (identity, getattr(track, 'gain', None), float(start), float(duration))
+
+
+def action_key(action):
+    """
+    Return a hashable key for the output of action: its type, and the track
+    identity, gain, start and duration of every span it reads, plus its mode
+    and, for the blends, the time-stretch backend.
+    Returns None when any source track can't be identified.
+    """
+    name = type(action).__name__
+    if hasattr(action, 'l1'):
+        # Blend, Mix and Crossmatch: two tracks, two lists of (start, duration).
+        ids = [track_identity(t) for t in (action.t1, action.t2)]
+        if None in ids:
+            return None
+        gains = (getattr(action.t1, 'gain', None), getattr(action.t2, 'gain', None))
+        lists = tuple(tuple((float(s), float(d)) for s, d in l) for l in (action.l1, action.l2))
+        return (name, tuple(ids), gains, lists, tuple(action.durations),
+                getattr(action, 'mode', None), action.stretch_backend)
+    if hasattr(action, 't1'):
+        # Crossfade and Jump: two Edits.
+        spans = tuple(_span(e.track, e.start, e.duration) for e in (action.t1, action.t2))
+        if None in spans:
+            return None
+        return (name, spans, action.mode)
+    span = _span(action.track, action.start, action.duration)
+    if span is None:
+        return None
+    return (name, span, getattr(action, 'mode', None))
+
+
+def _digest(key):
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+class RenderCache(object):
+    """
+    LRU of rendered AudioData within a byte budget, with an optional
+    on-disk tier that survives between sessions.
+    """
+    def __init__(self, max_bytes=256 * 2 ** 20, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _path(self, key):
+        return os.path.join(self.directory, _digest(key) + '.npz')
+
+    def get(self, key):
+        """Return the cached AudioData for key, or None."""
+        if key is None:
+            return None
+        with self.lock:
+            piece = self.entries.pop(key, None)
+            if piece is not None:
+                self.entries[key] = piece
+                self.hits += 1
+                return piece
+        if self.directory:
+            try:
+                stored = np.load(self._path(key))
+            except IOError:
+                pass
+            else:
+                try:
+                    data, sampleRate = stored['data'], int(stored['sampleRate'])
+                finally:
+                    stored.close()
+                piece = AudioData(ndarray=data, shape=data.shape, sampleRate=sampleRate,
+                                  numChannels=data.shape[1] if data.ndim == 2 else 1)
+                self._remember(key, piece)
+                with self.lock:
+                    self.disk_hits += 1
+                return piece
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def _remember(self, key, piece):
+        size = piece.data.nbytes
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old.data.nbytes
+            self.entries[key] = piece
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                k, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted.data.nbytes
+
+    def put(self, key, piece):
+        """Store piece under key, in memory and on disk if enabled."""
+        if key is None or piece is None:
+            return
+        # The cache keeps piece, so its buffer must never go back to the pool.
+        piece.pool_buffer = None
+        self._remember(key, piece)
+        if self.directory:
+            path = self._path(key)
+            if not os.path.exists(path):
+                tmp = '%s.%d.tmp' % (path, os.getpid())
+                with open(tmp, 'wb') as f:
+                    np.savez(f, data=piece.data, sampleRate=piece.sampleRate)
+                os.rename(tmp, path)
+
+    def render(self, action):
+        """Render action, or return its cached output."""
+        key = action_key(action)
+        piece = self.get(key)
+        if piece is None:
+            piece = render_trace.render(action)
+            self.put(key, piece)
+        return piece
+
+    def clear(self, disk=False):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+        if disk and self.directory:
+            for name in os.listdir(self.directory):
+                if name.endswith('.npz'):
+                    os.remove(os.path.join(self.directory, name))
+
+    def stats(self):
+        return {'hits': self.hits, 'disk_hits': self.disk_hits,
+                'misses': self.misses, 'entries': len(self.entries),
+                'bytes': self.bytes, 'max_bytes': self.max_bytes}
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# encoding: utf=8
+"""
+render_trace.py
+
+Optional instrumentation for rendering. While tracing is on, every action
+rendered through action.render (or a RenderCache, or a MixEngine) records
+its wall time, CPU time, samples produced and bytes of audio allocated for
+them. Decoding, time-stretching, assemble and encoding record spans of
+their own. Nothing is recorded, and almost nothing is spent, when tracing
+is off.
+
+    import render_trace
+    with render_trace.tracing('trace.json', format='chrome') as tracer:
+        action.render(actions, 'mix.mp3')
+    print(tracer.summary())
+
+JSON-lines output has one event per line. Chrome trace output loads in
+chrome://tracing or Perfetto. Events from parallel=True worker processes
+are not collected.
+"""
+from __future__ import print_function
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# CPU time of the whole process; thread CPU time isn't available on every platform.
+process_time = getattr(time, 'process_time', None) or time.clock
+
+ACTION = 'action'
+tracer = None
+
+
+class Tracer(object):
+    """Collects timed events from every thread."""
+    def __init__(self):
+        self.events = []
+        self.origin = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, name, category, start, wall, cpu, **args):
+        event = {'name': name, 'cat': category, 'ts': start - self.origin, 'wall': wall,
+                 'cpu': cpu, 'tid': threading.current_thread().ident}
+        event.update(args)
+        with self.lock:
+            self.events.append(event)
+        return event
+
+    def write_jsonl(self, path):
+        with open(path, 'w') as f:
+            for event in self.events:
+                f.write(json.dumps(event, sort_keys=True) + '\n')
+
+    def write_chrome(self, path):
+        pid = os.getpid()
+        fixed = ('name', 'cat', 'ts', 'wall', 'tid')
+        trace = [{'name': e['name'], 'cat': e['cat'], 'ph': 'X', 'pid': pid, 'tid': e['tid'],
+                  'ts': int(e['ts'] * 1e6), 'dur': int(e['wall'] * 1e6),
+                  'args': dict((k, v) for k, v in e.items() if k not in fixed)}
+                 for e in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+    def write(self, path, format='jsonl'):
+        if format == 'chrome':
+            self.write_chrome(path)
+        else:
+            self.write_jsonl(path)
+
+    def totals(self):
+        """{(category, name): {'count', 'wall', 'cpu', 'samples', 'bytes'}}"""
+        totals = {}
+        for e in self.events:
+            t = totals.setdefault((e['cat'], e['name']),
+                                  {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'samples': 0, 'bytes': 0})
+            t['count'] += 1
+            for key in ('wall', 'cpu', 'samples', 'bytes'):
+                t[key] += e.get(key) or 0
+        return totals
+
+    def summary(self):
+        """A table of the totals, actions first, slowest first within each group."""
+        totals = self.totals()
+        keys = sorted(totals, key=lambda k: (k[0] != ACTION, k[0], -totals[k]['wall']))
+        lines = ['%-10s %-14s %6s %10s %10s %10s %12s %10s' %
+                 ('category', 'name', 'count', 'wall s', 'cpu s', 'mean ms', 'samples', 'MB')]
+        for category, name in keys:
+            t = totals[(category, name)]
+            lines.append('%-10s %-14s %6d %10.3f %10.3f %10.2f %12d %10.1f' %
+                         (category, name, t['count'], t['wall'], t['cpu'],
+                          1000 * t['wall'] / t['count'], t['samples'], t['bytes'] / 2.0 ** 20))
+        return '\n'.join(lines)
+
+
+def _measure(data):
+    if data is None:
+        return {}
+    return {'samples': len(data), 'bytes': int(getattr(data, 'nbytes', 0))}
+
+
+@contextmanager
+def span(name, category='render', **args):
+    """Time the enclosed block. Yields a dict; set 'data' in it to the array the
+    block produced to record its samples and bytes."""
+    t = tracer
+    if t is None:
+        yield {}
+        return
+    result = {}
+    start, cpu = time.time(), process_time()
+    try:
+        yield result
+    finally:
+        wall, cpu = time.time() - start, process_time() - cpu
+        args.update(_measure(result.pop('data', None)))
+        t.record(name, category, start, wall, cpu, **args)
+
+
+def render(action):
+    """Call action.render(), recording it as an action event if tracing."""
+    if tracer is None:
+        return action.render()
+    with span(type(action).__name__, ACTION, action=str(action)) as result:
+        piece = action.render()
+        result['data'] = getattr(piece, 'data', None)
+    return piece
+
+
+def start():
+    """Begin collecting events and return the Tracer."""
+    global tracer
+    tracer = Tracer()
+    return tracer
+
+
+def stop():
+    """Stop collecting events and return the Tracer that collected them."""
+    global tracer
+    t, tracer = tracer, None
+    return t
+
+
+@contextmanager
+def tracing(path=None, format='jsonl', summary=False):
+    """Trace the enclosed block, then write the events to path and optionally
+    print the summary table."""
+    t = start()
+    try:
+        yield t
+    finally:
+        stop()
+        if path:
+            t.write(path, format)
+        if summary:
+            print(t.summary())
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# encoding: utf=8
+"""
+timestretch.py
+
+Pluggable time-stretch backends for Crossmatch.
+
+Every backend takes the same arguments as dirac.timeScale:
+    vecin       samples, (n,) or (n, channels)
+    rates       list of (sample offset into vecin, stretch factor); each
+                factor applies from its offset up to the next one
+    sampleRate  samples per second
+    quality     backend specific, 0 for the fastest
+
+'dirac' wraps the dirac binding, imported on first use. 'numpy' is a phase
+vocoder written with whole-array NumPy operations, for machines without the
+binding. time_scale() uses dirac when it can be imported, otherwise numpy.
+
+Stretched output is cached per (track, span, rates, backend) in cache, a
+render_cache.RenderCache; set cache to None to disable it.
+"""
+import numpy as np
+
+from render_cache import RenderCache
+
+FFT_SIZE = 2048
+OVERLAP = 4
+BLOCK_FRAMES = 256
+
+BACKENDS = {}
+cache = RenderCache(max_bytes=128 * 2 ** 20)
+
+
+def register(name, func):
+    """Make func available as a time-stretch backend called name."""
+    BACKENDS[name] = func
+
+
+def dirac_time_scale(vecin, rates, sampleRate, quality=0):
+    import dirac
+    return dirac.timeScale(vecin, rates, sampleRate, quality)
+
+
+def _time_map(n, rates, centres):
+    """
+    Input positions for output times centres, through the piecewise-linear
+    stretch given by rates, extended linearly past both ends.
+    """
+    starts = np.array([offset for offset, factor in rates] + [n], dtype=np.float64)
+    factors = np.array([factor for offset, factor in rates], dtype=np.float64)
+    starts[0] = 0
+    out_bounds = np.concatenate(([0], np.cumsum(np.diff(starts) * factors)))
+    reach = abs(centres[0]) + abs(centres[-1]) + 1
+    out_bounds = np.concatenate(([-reach], out_bounds, [out_bounds[-1] + reach]))
+    starts = np.concatenate(([-reach / factors[0]], starts, [n + reach / factors[-1]]))
+    return np.interp(centres, out_bounds, starts)
+
+
+def stretched_length(n, rates):
+    """Number of samples time_scale returns for n input samples."""
+    starts = np.array([offset for offset, factor in rates] + [n], dtype=np.float64)
+    starts[0] = 0
+    return int(round(np.sum(np.diff(starts) * [factor for offset, factor in rates])))
+
+
+def numpy_time_scale(vecin, rates, sampleRate, quality=0):
+    """
+    Phase vocoder time stretch. Each output frame takes its magnitudes from
+    the input frame its centre maps back to, and advances its phases by how
+    much that input moves over one hop, so pitch is unchanged.
+    """
+    x = np.asarray(vecin)
+    mono = x.ndim == 1
+    if mono:
+        x = x[:, np.newaxis]
+    n, channels = x.shape
+    size, hop = FFT_SIZE, FFT_SIZE // OVERLAP
+    length = stretched_length(n, rates)
+
+    # Frame k is centred on output sample centres[k]; the first starts early
+    # enough that the overlap is complete from sample 0.
+    centres = np.arange(hop - size // 2, length + size // 2 + hop, hop)
+    starts = np.round(_time_map(n, rates, centres)).astype(np.int64) - size // 2
+
+    # Pad so every frame and its one-hop-later twin lie inside the signal.
+    pad = 2 * size
+    padded = np.zeros((n + 2 * pad + hop, channels), dtype=np.float32)
+    padded[pad:pad + n] = x
+    starts = np.clip(starts + pad, 0, n + pad)
+    window = np.hanning(size + 1)[:-1].astype(np.float32)
+    offsets = np.arange(size)
+
+    frames = len(starts)
+    out = np.zeros((frames * hop + size, channels), dtype=np.float64)
+    phase = None
+    for b in xrange(0, frames, BLOCK_FRAMES):
+        index = starts[b:b + BLOCK_FRAMES, np.newaxis] + offsets
+        now = np.fft.rfft(padded[index] * window[:, np.newaxis], axis=1)
+        later = np.fft.rfft(padded[index + hop] * window[:, np.newaxis], axis=1)
+        advance = np.angle(later) - np.angle(now)
+        # Frame k's phase is frame 0's plus the advances of frames 0..k-1.
+        first = np.angle(now[0]) if phase is None else phase
+        phases = np.cumsum(np.concatenate((first[np.newaxis], advance[:-1])), axis=0)
+        phase = np.mod(phases[-1] + advance[-1], 2 * np.pi)
+        grains = np.fft.irfft(np.abs(now) * np.exp(1j * phases), n=size, axis=1)
+        grains *= window[:, np.newaxis]
+        # Frames OVERLAP apart don't overlap each other, so add them a group at a time.
+        for r in xrange(OVERLAP):
+            group = grains[r::OVERLAP]
+            start = (b + r) * hop
+            out[start:start + len(group) * size] += group.reshape(-1, channels)
+
+    # Frame 0 starts at output sample hop - size. The overlapped squared
+    # windows sum to a constant, which undoes the windowing.
+    out = out[size - hop:size - hop + length] / (np.sum(window ** 2) / hop)
+    if np.issubdtype(x.dtype, np.integer):
+        info = np.iinfo(x.dtype)
+        out = np.clip(np.round(out), info.min, info.max)
+    out = out.astype(x.dtype)
+    return out[:, 0] if mono else out
+
+
+register('dirac', dirac_time_scale)
+register('numpy', numpy_time_scale)
+
+
+def default_backend():
+    try:
+        import dirac
+        return 'dirac'
+    except ImportError:
+        return 'numpy'
+
+
+def time_scale(vecin, rates, sampleRate, quality=0, backend=None):
+    """Stretch vecin by rates with the named backend (default_backend() if None)."""
+    return BACKENDS[backend or default_backend()](vecin, rates, sampleRate, quality)